@@ -0,0 +1,532 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the Apache License, Version 2.0
+# found in the LICENSE file in the root directory of this source tree.
+
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import time
+import weakref
+
+import numpy as np
+import torch
+import torchvision.transforms as T
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+from models.backbone import ATTN_BACKENDS, Attention
+
+# embed_dim, num_heads of the backbones built in inference.SSLAE
+VARIANTS = {'large': (1024, 16), 'huge': (1280, 20)}
+# DPTHead arguments of the decoders built in inference.SSLAE
+HEAD_KWARGS = {'large': dict(),
+               'huge': dict(in_channels=(1280, 1280, 1280, 1280), embed_dims=1280,
+                            post_process_channels=[160, 320, 640, 1280])}
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def pss_mb():
+    """Proportional set size: shared pages are divided among the processes mapping them."""
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1]) / 2**10
+
+
+def time_fn(fn, repeats=5, warmup=1):
+    """Mean latency of fn() in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return 1000 * (time.perf_counter() - start) / repeats
+
+
+def _isolated_target(queue, fn, args):
+    queue.put(fn(*args))
+
+
+def run_isolated(fn, *args):
+    """Run fn(*args) in a fresh process, so that the peak RSS it reports
+    is not inflated by the configurations measured before it."""
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_isolated_target, args=(queue, fn, args))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def _bench_attention(variant, backend, tile_size, bs, repeats, chunk_size):
+    torch.manual_seed(0)
+    dim, num_heads = VARIANTS[variant]
+    n_tokens = (tile_size // 16) ** 2 + 1
+    x = torch.randn(bs, n_tokens, dim)
+    attn = Attention(dim, num_heads=num_heads, qkv_bias=True, attn_backend=backend,
+                     attn_chunk_size=chunk_size).eval()
+    with torch.no_grad():
+        before = rss_mb()
+        out = attn(x)
+        peak = peak_rss_mb() - before
+        latency = time_fn(lambda: attn(x), repeats=repeats)
+        # reference output of the original math path
+        attn.attn_backend = 'math'
+        max_diff = (out - attn(x)).abs().max().item()
+    return dict(variant=variant, backend=backend, tile_size=tile_size, tokens=n_tokens,
+                latency_ms=latency, peak_mb=max(peak, 0.0), max_diff=max_diff)
+
+
+def bench_attention(args):
+    print(f"{'variant':>8} {'backend':>8} {'tile':>6} {'tokens':>7} {'ms':>10} {'peak MB':>9} {'max diff':>10}")
+    for tile_size in args.tile_sizes:
+        for backend in args.backends:
+            r = run_isolated(_bench_attention, args.variant, backend, tile_size, args.bs, args.repeats,
+                             args.chunk_size)
+            print(f"{r['variant']:>8} {r['backend']:>8} {r['tile_size']:>6} {r['tokens']:>7} "
+                  f"{r['latency_ms']:>10.1f} {r['peak_mb']:>9.1f} {r['max_diff']:>10.2e}")
+
+
+def _module_mb(module):
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / 2**20
+
+
+def _bench_truncate(variant, inference_only, tile_size, bs, repeats):
+    from inference import SSLAE
+
+    torch.manual_seed(0)
+    before = rss_mb()
+    backbone = SSLAE(huge=variant == 'huge', inference_only=inference_only).backbone.eval()
+    resident = rss_mb() - before
+    x = torch.randn(bs, 3, tile_size, tile_size)
+    with torch.no_grad():
+        latency = time_fn(lambda: backbone(x), repeats=repeats)
+    return dict(variant=variant, inference_only=inference_only, blocks=len(backbone.blocks),
+                weights_mb=_module_mb(backbone), rss_mb=resident, latency_ms=latency)
+
+
+def bench_truncate(args):
+    print(f"{'variant':>8} {'mode':>10} {'blocks':>7} {'weights MB':>11} {'RSS MB':>9} {'ms':>10}")
+    for variant in args.variants:
+        full, lean = [run_isolated(_bench_truncate, variant, inference_only, args.tile_size, args.bs, args.repeats)
+                      for inference_only in (False, True)]
+        for r in (full, lean):
+            mode = 'inference' if r['inference_only'] else 'full'
+            print(f"{variant:>8} {mode:>10} {r['blocks']:>7} {r['weights_mb']:>11.1f} {r['rss_mb']:>9.1f} "
+                  f"{r['latency_ms']:>10.1f}")
+        print(f"{variant:>8} {'saved':>10} {full['blocks'] - lean['blocks']:>7} "
+              f"{full['weights_mb'] - lean['weights_mb']:>11.1f} {full['rss_mb'] - lean['rss_mb']:>9.1f} "
+              f"{full['latency_ms'] - lean['latency_ms']:>10.1f}")
+
+
+def load_tiles(path, n_tiles):
+    """Normalized (n, 3, H, W) batch of the first n_tiles png tiles in path."""
+    from inference import NORM_MEAN, NORM_STD, load_png_tiles
+
+    return T.Normalize(NORM_MEAN, NORM_STD)(load_png_tiles(path, n_tiles))
+
+
+def bench_tome(args):
+    from inference import SSLModule
+
+    model = SSLModule(ssl_path=args.checkpoint).eval()
+    backbone = model.chm_module_.backbone
+    tiles = load_tiles(args.tiles, args.n_tiles)
+    batches = tiles.split(args.bs)
+
+    def predict():
+        return torch.cat([model(b) for b in batches])
+
+    print(f"{'merged/block':>12} {'tiles/s':>9} {'speedup':>8} {'MAE (m)':>8} {'max err (m)':>12}")
+    ref, ref_latency = None, None
+    for r in args.ratios:
+        backbone.set_token_merging(r)
+        with torch.no_grad():
+            pred = predict()
+            latency = time_fn(predict, repeats=args.repeats, warmup=0)
+        if ref is None:
+            ref, ref_latency = pred, latency
+        err = (pred - ref).abs()
+        print(f"{r:>12} {1000 * len(tiles) / latency:>9.2f} {ref_latency / latency:>8.2f} "
+              f"{err.mean().item():>8.3f} {err.max().item():>12.3f}")
+
+
+def _bench_coldstart(path, tile_size):
+    start = time.perf_counter()
+    from inference import SSLModule, is_artifact, load_artifact
+    imported = time.perf_counter()
+    if is_artifact(path):
+        model, _ = load_artifact(path)
+    else:
+        model = SSLModule(ssl_path=path).eval()
+    loaded = time.perf_counter()
+    with torch.no_grad():
+        model(torch.zeros(1, 3, tile_size, tile_size))
+    predicted = time.perf_counter()
+    return dict(import_s=imported - start, load_s=loaded - imported, first_pred_s=predicted - loaded,
+                total_s=predicted - start, peak_rss_mb=peak_rss_mb())
+
+
+def bench_coldstart(args):
+    print(f"{'model':>40} {'import s':>9} {'load s':>7} {'1st pred s':>11} {'total s':>8} {'peak RSS MB':>12}")
+    for path in args.models:
+        r = run_isolated(_bench_coldstart, path, args.tile_size)
+        print(f"{os.path.basename(path):>40} {r['import_s']:>9.2f} {r['load_s']:>7.2f} {r['first_pred_s']:>11.2f} "
+              f"{r['total_s']:>8.2f} {r['peak_rss_mb']:>12.0f}")
+
+
+def _rss_worker(queue, barrier, checkpoint, normnet, mmap, tile_size):
+    from inference import SSLModule, load_normnet
+
+    model = SSLModule(ssl_path=checkpoint, mmap=mmap).eval()
+    model_norm = load_normnet(normnet, mmap=mmap)
+    with torch.no_grad():
+        x = torch.zeros(1, 3, tile_size, tile_size)
+        model(x)
+        model_norm(x)
+    # measure once every worker holds its weights
+    barrier.wait()
+    queue.put(dict(rss_mb=rss_mb(), pss_mb=pss_mb()))
+    barrier.wait()
+
+
+def bench_rss(args):
+    ctx = mp.get_context('spawn')
+    print(f"{'checkpoint':>32} {'mmap':>5} {'workers':>8} {'RSS/worker MB':>14} {'PSS/worker MB':>14} {'PSS total MB':>13}")
+    for checkpoint in args.checkpoints:
+        for mmap in (False, True):
+            queue, barrier = ctx.Queue(), ctx.Barrier(args.workers)
+            procs = [ctx.Process(target=_rss_worker,
+                                 args=(queue, barrier, checkpoint, args.normnet, mmap, args.tile_size))
+                     for _ in range(args.workers)]
+            for p in procs:
+                p.start()
+            results = [queue.get() for _ in procs]
+            for p in procs:
+                p.join()
+            rss = sum(r['rss_mb'] for r in results) / len(results)
+            pss = sum(r['pss_mb'] for r in results)
+            print(f"{os.path.basename(checkpoint):>32} {str(mmap):>5} {args.workers:>8} {rss:>14.0f} "
+                  f"{pss / len(results):>14.0f} {pss:>13.0f}")
+
+
+def _decode_bins_reference(logit, min_depth=0.001, max_depth=10, eps=0.1):
+    # bin decoding of DPTHead before decode_bins
+    bins = torch.linspace(min_depth, max_depth, logit.shape[1], device=logit.device)
+    logit = torch.relu(logit)
+    logit = logit + eps
+    logit = logit / logit.sum(dim=1, keepdim=True)
+    return torch.einsum('ikmn,k->imn', [logit, bins]).unsqueeze(dim=1)
+
+
+def _bench_bins(lean, tile_size, bs, n_bins, bin_chunk_size):
+    from models.dpt_head import DPTHead
+
+    head = DPTHead(classify=True, n_bins=n_bins, bin_chunk_size=bin_chunk_size)
+    torch.manual_seed(0)
+    logit = torch.randn(bs, n_bins, tile_size, tile_size)
+    before = rss_mb()
+    start = time.perf_counter()
+    out = head.decode_bins(logit) if lean else _decode_bins_reference(logit)
+    latency = 1000 * (time.perf_counter() - start)
+    peak = peak_rss_mb() - before
+    return dict(logits_mb=logit.numel() * logit.element_size() / 2**20, peak_mb=max(peak, 0.0),
+                latency_ms=latency, out=out)
+
+
+def bench_bins(args):
+    print(f"{'decoding':>10} {'tile':>6} {'logits MB':>10} {'extra peak MB':>14} {'ms':>8} {'max diff (m)':>13}")
+    for tile_size in args.tile_sizes:
+        # each decoding runs alone in its process, from the same logits: the peak
+        # RSS is a high-water mark, the reference would otherwise set the lean one
+        ref = None
+        for lean in (False, True):
+            r = run_isolated(_bench_bins, lean, tile_size, args.bs, args.n_bins, args.bin_chunk_size)
+            ref = r['out'] if ref is None else ref
+            max_diff = (r['out'] - ref).abs().max().item()
+            print(f"{'lean' if lean else 'reference':>10} {tile_size:>6} {r['logits_mb']:>10.0f} "
+                  f"{r['peak_mb']:>14.0f} {r['latency_ms']:>8.1f} {max_diff:>13.2e}")
+
+
+def bench_head(args):
+    from models.dpt_head import DPTHead
+
+    torch.manual_seed(0)
+    head = DPTHead(classify=True, **HEAD_KWARGS[args.variant]).eval()
+    dim = head.reassemble_blocks.readout_projects[0][0].out_features
+    print(f"{'variant':>8} {'tile':>6} {'ms':>10} {'fast ms':>10} {'speedup':>8} {'max diff (m)':>13}")
+    for tile_size in args.tile_sizes:
+        n = tile_size // 16
+        # backbone outputs: (patch feature map, cls token) of each tap
+        inputs = [(torch.randn(args.bs, dim, n, n), torch.randn(args.bs, dim)) for _ in range(4)]
+        results = []
+        for fast_topology in (False, True):
+            head.set_fast_topology(fast_topology)
+            out = head(inputs)
+            results.append((out, time_fn(lambda: head(inputs), repeats=args.repeats)))
+        (ref, latency), (out, fast_latency) = results
+        # heights in meters, as scaled by SSLModule
+        max_diff = 10 * (out - ref).abs().max().item()
+        print(f"{args.variant:>8} {tile_size:>6} {latency:>10.1f} {fast_latency:>10.1f} "
+              f"{latency / fast_latency:>8.2f} {max_diff:>13.2e}")
+
+
+class AllocationTracker(TorchDispatchMode):
+    """Bytes of the tensors allocated by the operators run under this mode,
+    live at a time and in total, and their peak per module of `modules`
+    (name -> module) over the calls of the module. Views and the outputs of in
+    place operators share the storage of a tracked tensor and are not counted."""
+    def __init__(self, modules):
+        super().__init__()
+        self.live, self.peak = 0, 0
+        self.storages = {}
+        self.report = {name: dict(peak=0, total=0) for name in modules}
+        self.total = 0
+        self._stack = []
+        self._handles = []
+        for name, module in modules.items():
+            self._handles.append(module.register_forward_pre_hook(lambda m, i, name=name: self._enter(name)))
+            self._handles.append(module.register_forward_hook(lambda m, i, o, name=name: self._exit(name)))
+
+    def _enter(self, name):
+        self._stack.append((name, self.live, self.peak, self.total))
+        self.peak = self.live
+
+    def _exit(self, name):
+        _, live, peak, total = self._stack.pop()
+        stats = self.report[name]
+        stats['peak'] = max(stats['peak'], self.peak - live)
+        stats['total'] += self.total - total
+        self.peak = max(peak, self.peak)
+
+    def _free(self, ptr):
+        self.live -= self.storages.pop(ptr)
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for t in tree_flatten(out)[0]:
+            if not isinstance(t, torch.Tensor):
+                continue
+            storage = t.untyped_storage()
+            ptr = storage.data_ptr()
+            if ptr in self.storages or storage.nbytes() == 0:
+                continue
+            self.storages[ptr] = storage.nbytes()
+            self.live += storage.nbytes()
+            self.total += storage.nbytes()
+            self.peak = max(self.peak, self.live)
+            weakref.finalize(t, self._free, ptr)
+        return out
+
+    def remove(self):
+        for handle in self._handles:
+            handle.remove()
+
+
+def bench_allocs(args):
+    from models.dpt_head import DPTHead
+
+    torch.manual_seed(0)
+    head = DPTHead(classify=True, **HEAD_KWARGS[args.variant]).eval()
+    dim = head.reassemble_blocks.readout_projects[0][0].out_features
+    n = args.tile_size // 16
+    inputs = [(torch.randn(args.bs, dim, n, n), torch.randn(args.bs, dim)) for _ in range(4)]
+    modules = {'head': head, 'reassemble_blocks': head.reassemble_blocks, 'project': head.project,
+               'conv_depth': head.conv_depth}
+    for i, block in enumerate(head.fusion_blocks):
+        modules[f'fusion_blocks.{i}'] = block
+        for unit in ('res_conv_unit1', 'res_conv_unit2'):
+            if getattr(block, unit) is not None:
+                modules[f'fusion_blocks.{i}.{unit}'] = getattr(block, unit)
+    reports = []
+    for inplace in (False, True):
+        head.set_inplace(inplace)
+        tracker = AllocationTracker(modules)
+        with tracker:
+            head(inputs)
+        tracker.remove()
+        reports.append(tracker.report)
+    print(f"{'module':>32} {'peak MB':>9} {'inplace':>9} {'allocated MB':>13} {'inplace':>9}")
+    for name in modules:
+        (default, inplace) = (r[name] for r in reports)
+        print(f"{name:>32} {default['peak'] / 2**20:>9.1f} {inplace['peak'] / 2**20:>9.1f} "
+              f"{default['total'] / 2**20:>13.1f} {inplace['total'] / 2**20:>9.1f}")
+
+
+def _percentiles_reference(img):
+    # per image percentiles of NeonDataset before the batched normalization
+    p5, p95 = [], []
+    for x in img:
+        p5.append([np.percentile(x[i, :, :].flatten(), 5) for i in range(3)])
+        p95.append([np.percentile(x[i, :, :].flatten(), 95) for i in range(3)])
+    return torch.tensor(np.stack((p5, p95)))
+
+
+def bench_percentiles(args):
+    from inference import percentiles
+
+    torch.manual_seed(0)
+    # 8 bit images as read by TF.to_tensor
+    img = torch.randint(0, 256, (args.bs, 3, args.tile_size, args.tile_size)).float() / 255
+    ref = _percentiles_reference(img)
+    methods = {'numpy': lambda: _percentiles_reference(img),
+               'sort': lambda: percentiles(img, (5, 95)),
+               'histogram': lambda: percentiles(img, (5, 95), levels=256),
+               'uint8': lambda: percentiles((img * 255).round().to(torch.uint8), (5, 95)) / 255}
+    print(f"{'method':>10} {'ms/batch':>9} {'speedup':>8} {'max diff':>10}")
+    ref_latency = None
+    for name, fn in methods.items():
+        latency = time_fn(fn, repeats=args.repeats)
+        ref_latency = ref_latency or latency
+        max_diff = (fn().double() - ref).abs().max().item()
+        print(f"{name:>10} {latency:>9.1f} {ref_latency / latency:>8.1f} {max_diff:>10.2e}")
+
+
+def _seam_error(merged, tile_size):
+    """Mean absolute height jump between neighboring pixels across the
+    borders of the non overlapping tile grid, and elsewhere."""
+    jumps = [np.abs(np.diff(merged, axis=1)), np.abs(np.diff(merged, axis=0)).T]
+    seam, other = [], []
+    for jump in jumps:
+        # jump[:, c - 1] is between columns c - 1 and c
+        is_seam = np.zeros(jump.shape[1], dtype=bool)
+        is_seam[tile_size - 1::tile_size] = True
+        seam.append(jump[:, is_seam].ravel())
+        other.append(jump[:, ~is_seam].ravel())
+    return np.concatenate(seam).mean(), np.concatenate(other).mean()
+
+
+def bench_overlap(args):
+    import tiling
+    from inference import NORM_MEAN, NORM_STD, SSLModule
+
+    model = SSLModule(ssl_path=args.checkpoint).eval()
+    norm = T.Normalize(NORM_MEAN, NORM_STD)
+    scene = tiling.load_scene(args.scene)[:args.max_size, :args.max_size]
+    height, width = scene.shape[:2]
+    print(f"{'stride':>7} {'tiles':>6} {'cost':>6} {'s':>8} {'seam jump (m)':>14} {'other jump (m)':>15} {'ratio':>6}")
+    n_tiles = None
+    for stride in args.strides:
+        sink = tiling.ArraySink(height, width)
+        merger = tiling.BlendMerger(height, width, args.tile_size, sink=sink, window=args.window)
+        tiles = tiling.iter_tiles(scene, args.tile_size, batch_size=args.bs, stride=stride)
+        n = 0
+        start = time.perf_counter()
+        for preds, offsets in tiling.predict_tiles(lambda x: model(norm(x)), tiles):
+            merger.add_batch(preds, offsets)
+            n += len(preds)
+        merger.close()
+        elapsed = time.perf_counter() - start
+        n_tiles = n_tiles or n
+        # area covered by the non overlapping grid, the same for every stride
+        covered = sink.array[:height - height % args.tile_size, :width - width % args.tile_size]
+        seam, other = _seam_error(covered, args.tile_size)
+        print(f"{stride:>7} {n:>6} {n / n_tiles:>6.2f} {elapsed:>8.1f} {seam:>14.3f} {other:>15.3f} {seam / other:>6.2f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='latency and peak memory benchmarks (CPU)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('attention', help='compare attention backends of the ViT blocks')
+    p.add_argument('--variant', type=str, choices=list(VARIANTS), default='huge')
+    p.add_argument('--backends', type=str, nargs='+', default=list(ATTN_BACKENDS))
+    p.add_argument('--tile_sizes', type=int, nargs='+', default=[256, 512, 1024])
+    p.add_argument('--bs', type=int, default=1)
+    p.add_argument('--repeats', type=int, default=5)
+    p.add_argument('--chunk_size', type=int, default=256, help='queries per chunk of the chunked backend')
+    p.set_defaults(func=bench_attention)
+
+    p = subparsers.add_parser('truncate', help='full backbone vs inference_only backbone')
+    p.add_argument('--variants', type=str, nargs='+', choices=list(VARIANTS), default=list(VARIANTS))
+    p.add_argument('--tile_size', type=int, default=256)
+    p.add_argument('--bs', type=int, default=1)
+    p.add_argument('--repeats', type=int, default=3)
+    p.set_defaults(func=bench_truncate)
+
+    p = subparsers.add_parser('tome', help='accuracy vs throughput of token merging on png tiles')
+    p.add_argument('--checkpoint', type=str, default='saved_checkpoints/compressed_SSLhuge.pth')
+    p.add_argument('--tiles', type=str, default='highResMeta/crop')
+    p.add_argument('--n_tiles', type=int, default=64)
+    p.add_argument('--ratios', type=int, nargs='+', default=[0, 2, 4, 8, 12],
+                   help='tokens merged after each block, the first one is the reference')
+    p.add_argument('--bs', type=int, default=16)
+    p.add_argument('--repeats', type=int, default=1)
+    p.set_defaults(func=bench_tome)
+
+    p = subparsers.add_parser('coldstart', help='time and peak RSS from a fresh process to the first prediction')
+    p.add_argument('--models', type=str, nargs='+', required=True,
+                   help='checkpoints and/or artifacts written by export.py --artifact')
+    p.add_argument('--tile_size', type=int, default=256)
+    p.set_defaults(func=bench_coldstart)
+
+    p = subparsers.add_parser('rss', help='memory per worker process with and without memory mapped weights')
+    p.add_argument('--checkpoints', type=str, nargs='+',
+                   default=['saved_checkpoints/SSLhuge_satellite.pth', 'saved_checkpoints/compressed_SSLhuge.pth'])
+    p.add_argument('--normnet', type=str, default='saved_checkpoints/aerial_normalization_quantiles_predictor.ckpt')
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--tile_size', type=int, default=256)
+    p.set_defaults(func=bench_rss)
+
+    p = subparsers.add_parser('bins', help='peak memory of the classification bin decoding of DPTHead')
+    p.add_argument('--tile_sizes', type=int, nargs='+', default=[256, 512])
+    p.add_argument('--bs', type=int, default=16)
+    p.add_argument('--n_bins', type=int, default=256)
+    p.add_argument('--bin_chunk_size', type=int, default=32)
+    p.set_defaults(func=bench_bins)
+
+    p = subparsers.add_parser('head', help='latency of the decoder with and without the fast topology')
+    p.add_argument('--variant', type=str, choices=list(VARIANTS), default='huge')
+    p.add_argument('--tile_sizes', type=int, nargs='+', default=[256, 512, 1024])
+    p.add_argument('--bs', type=int, default=1)
+    p.add_argument('--repeats', type=int, default=3)
+    p.set_defaults(func=bench_head)
+
+    p = subparsers.add_parser('allocs', help='per module peak and total allocations of the decoder, with and without in place execution')
+    p.add_argument('--variant', type=str, choices=list(VARIANTS), default='huge')
+    p.add_argument('--tile_size', type=int, default=256)
+    p.add_argument('--bs', type=int, default=16)
+    p.set_defaults(func=bench_allocs)
+
+    p = subparsers.add_parser('percentiles', help='per channel percentiles of a batch of tiles: numpy loop vs batched')
+    p.add_argument('--tile_size', type=int, default=256)
+    p.add_argument('--bs', type=int, default=16)
+    p.add_argument('--repeats', type=int, default=5)
+    p.set_defaults(func=bench_percentiles)
+
+    p = subparsers.add_parser('overlap', help='compute cost and seam error of overlapping tiles blended in the mosaic')
+    p.add_argument('--scene', type=str, default='highResMeta/SiteC.png')
+    p.add_argument('--checkpoint', type=str, default='saved_checkpoints/compressed_SSLhuge.pth')
+    p.add_argument('--max_size', type=int, default=2048, help='crop of the scene used, in pixels')
+    p.add_argument('--tile_size', type=int, default=256)
+    p.add_argument('--strides', type=int, nargs='+', default=[256, 224, 192, 128],
+                   help='the first one is the reference of the compute cost')
+    p.add_argument('--window', type=str, choices=['hann', 'uniform'], default='hann')
+    p.add_argument('--bs', type=int, default=16)
+    p.set_defaults(func=bench_overlap)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    torch.set_grad_enabled(False)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the Apache License, Version 2.0
+# found in the LICENSE file in the root directory of this source tree.
+
+import argparse
+import json
+import os
+
+import torch
+import torch.nn as nn
+import torchvision.transforms as T
+
+from inference import (ARTIFACT_METADATA, NORM_MEAN, NORM_STD, SSLAE, SSLModule, load_png_tiles,
+                       quantize_static_head)
+
+
+def export_static_head(checkpoint, output, calibration, n_calibration=64, bs=16, backend=None):
+    """Write a compressed checkpoint with dynamic int8 Linear layers and a
+    statically quantized int8 decoder, calibrated on the png tiles of the
+    `calibration` directory. Loaded by SSLModule like the other compressed
+    checkpoints."""
+    assert 'compressed' not in checkpoint, 'static quantization starts from a float checkpoint'
+    backend = backend or torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+
+    model = SSLAE(classify=True, huge='huge' in checkpoint).eval()
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu')['state_dict'])
+    tiles = T.Normalize(NORM_MEAN, NORM_STD)(load_png_tiles(calibration, n_calibration))
+    quantize_static_head(model, tiles.split(bs), backend=backend)
+    torch.save({'quantization': 'static_head', 'backend': backend, 'state_dict': model.state_dict()}, output)
+
+
+class CHMPredictor(nn.Module):
+    """SSLAE with the output scaling of SSLModule, as a plain module that can be traced."""
+    def __init__(self, model, scale=10):
+        super().__init__()
+        self.model = model
+        self.scale = scale
+
+    def forward(self, x):
+        return self.scale * self.model(x)
+
+
+def export_artifact(checkpoint, output, tile_size=256, **options):
+    """Write a self-contained, ready to run TorchScript artifact of a
+    checkpoint (float, compressed or static_head compressed), loaded by
+    inference.load_artifact without building nor quantizing the model again.
+    The model is traced with the inference-only backbone and frozen, so weights
+    are pre-packed and constants folded. The resized position embeddings are
+    baked in: the artifact is specialized to tiles of `tile_size` pixels."""
+    model = SSLModule(ssl_path=checkpoint, inference_only=True, **options).eval()
+    predictor = CHMPredictor(model.chm_module_).eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(predictor, torch.zeros(1, 3, tile_size, tile_size), check_trace=False)
+    traced = torch.jit.freeze(traced)
+    metadata = dict(
+        variant='huge' if 'huge' in checkpoint else 'large',
+        checkpoint=os.path.basename(checkpoint),
+        tile_size=tile_size,
+        norm_mean=NORM_MEAN,
+        norm_std=NORM_STD,
+        quantized_engine=torch.backends.quantized.engine,
+        torch_version=torch.__version__,
+        options=options,
+    )
+    torch.jit.save(traced, output, _extra_files={ARTIFACT_METADATA: json.dumps(metadata)})
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='export a CHM model for deployment: static int8 decoder checkpoint or TorchScript artifact')
+    parser.add_argument('--checkpoint', type=str, help='float CHM pred checkpoint file', default='saved_checkpoints/SSLhuge_satellite.pth')
+    parser.add_argument('--output', type=str, help='output file, defaults to compressed_static_<checkpoint name> next to the checkpoint')
+    parser.add_argument('--calibration', type=str, help='directory of png tiles used to calibrate the quantized decoder', default='highResMeta/crop')
+    parser.add_argument('--n_calibration', type=int, help='number of calibration tiles', default=64)
+    parser.add_argument('--backend', type=str, help='quantized engine the model will run with: fbgemm (x86) or qnnpack (ARM)')
+    parser.add_argument('--artifact', action='store_true', help='write a ready to run TorchScript artifact of the checkpoint instead')
+    parser.add_argument('--tile_size', type=int, help='tile size the artifact is specialized to', default=256)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.backend:
+        torch.backends.quantized.engine = args.backend
+    if args.artifact:
+        output = args.output or os.path.splitext(args.checkpoint)[0] + '_artifact.pt'
+        export_artifact(args.checkpoint, output, args.tile_size)
+        print(f'saved {output}')
+        return
+
+    output = args.output
+    if output is None:
+        output = os.path.join(os.path.dirname(args.checkpoint), 'compressed_static_' + os.path.basename(args.checkpoint))
+    # SSLModule picks the variant and the quantized loading path from the file name
+    assert 'compressed' in os.path.basename(output), 'the output file name must contain "compressed"'
+    assert ('huge' in args.checkpoint) == ('huge' in os.path.basename(output)), \
+        'the output file name must contain "huge" exactly when the checkpoint does'
+    export_static_head(args.checkpoint, output, args.calibration, args.n_calibration, backend=args.backend)
+    print(f'saved {output}')
+
+
+if __name__ == '__main__':
+    main()
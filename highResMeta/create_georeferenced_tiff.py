@@ -1,9 +1,14 @@
 import os
+import sys
+from pathlib import Path
 import numpy as np
 from osgeo import gdal, osr
 import xml.etree.ElementTree as ET
 import re
 
+sys.path.append(str(Path(__file__).parent.parent))
+from raster_io import GeoTiffWriter
+
 def extract_coordinates_from_kml(kml_path):
     # Parse KML file
     tree = ET.parse(kml_path)
@@ -26,7 +31,8 @@ def extract_coordinates_from_kml(kml_path):
     
     return coords
 
-def create_geotiff(chm_array, kml_path, output_path):
+def kml_geotransform(kml_path, width, height):
+    """Geotransform of a (height, width) raster spanning the bounds of the KML coordinates."""
     # Load coordinates from KML
     coords = extract_coordinates_from_kml(kml_path)
     
@@ -36,43 +42,41 @@ def create_geotiff(chm_array, kml_path, output_path):
     min_lon, max_lon = min(lons), max(lons)
     min_lat, max_lat = min(lats), max(lats)
     
-    # Get array dimensions
-    height, width = chm_array.shape
-    
     # Calculate pixel size
     pixel_width = (max_lon - min_lon) / width
     pixel_height = (max_lat - min_lat) / height
     
     # Create geotransform
     # (top_left_x, pixel_width, 0, top_left_y, 0, -pixel_height)
-    geotransform = (min_lon, pixel_width, 0, max_lat, 0, -pixel_height)
-    
-    # Create the GeoTIFF
-    driver = gdal.GetDriverByName('GTiff')
-    dataset = driver.Create(output_path, width, height, 1, gdal.GDT_Float32)
-    
-    # Set geotransform and projection
-    dataset.SetGeoTransform(geotransform)
-    
-    # Set projection to WGS84
+    return (min_lon, pixel_width, 0, max_lat, 0, -pixel_height)
+
+def wgs84_wkt():
     srs = osr.SpatialReference()
     srs.SetWellKnownGeogCS('WGS84')
-    dataset.SetProjection(srs.ExportToWkt())
-    
-    # Write the data
-    band = dataset.GetRasterBand(1)
-    band.WriteArray(chm_array)
-    band.SetNoDataValue(-9999)
-    
-    # Close the dataset
-    dataset = None
+    return srs.ExportToWkt()
 
-# Load the merged CHM
-merged_chm = np.load("merged_CHM.npy")
+def open_geotiff(kml_path, output_path, width, height, compress='DEFLATE'):
+    """Tiled, compressed Float32 GeoTIFF in WGS84 spanning the KML bounds, to
+    be written window by window (it can be the sink of tiling.BlendMerger)."""
+    return GeoTiffWriter(output_path, width, height, geotransform=kml_geotransform(kml_path, width, height),
+                         projection=wgs84_wkt(), dtype=gdal.GDT_Float32, compress=compress)
 
-# Create georeferenced TIFF
-kml_path = "highResMeta/kml.kml"
-output_tiff = "merged_CHM_satellite.tif"
+def create_geotiff(chm_array, kml_path, output_path, strip_rows=256):
+    # Get array dimensions
+    height, width = chm_array.shape
+    
+    # Write the data by strips of rows: chm_array can be memory mapped
+    with open_geotiff(kml_path, output_path, width, height) as writer:
+        for row in range(0, height, strip_rows):
+            writer.write(np.asarray(chm_array[row:row + strip_rows], dtype=np.float32), row)
 
-create_geotiff(merged_chm, kml_path, output_tiff)
-print(f"Created georeferenced TIFF file: {output_tiff}") 
\ No newline at end of file
+if __name__ == '__main__':
+    # Load the merged CHM, memory mapped
+    merged_chm = np.load("merged_CHM.npy", mmap_mode='r')
+    
+    # Create georeferenced TIFF
+    kml_path = "highResMeta/kml.kml"
+    output_tiff = "merged_CHM_satellite.tif"
+    
+    create_geotiff(merged_chm, kml_path, output_tiff)
+    print(f"Created georeferenced TIFF file: {output_tiff}")
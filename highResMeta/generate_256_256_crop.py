@@ -1,7 +1,13 @@
 import os
+import sys
+from pathlib import Path
 import numpy as np
 from PIL import Image
 
+sys.path.append(str(Path(__file__).parent.parent))
+import tiling
+from raster_io import WindowedReader
+
 # Input image path
 image_path = "highResMeta/SiteC.png"
 
@@ -10,31 +16,32 @@ output_dir = "crop"
 if not os.path.exists(output_dir):
     os.makedirs(output_dir)
 
-# Load the image
-img = Image.open(image_path)
-width, height = img.size
+# Open the image: rows are read by strips aligned on its blocks, the image never needs to fit in memory.
+# Palette images are expanded to RGB, as the crops are read by run_custom.py
+reader = WindowedReader(image_path, read_ahead=1)
+height, width = reader.shape[:2]
 
 # Define the crop size
 crop_size = 256
+# Distance between crops: crops overlap by crop_size - stride pixels, blended by merge_256_256_crop_CHM.py
+stride = 256
 
-# Calculate number of crops in each dimension
-num_crops_w = width // crop_size
-num_crops_h = height // crop_size
+# Offsets of the crops in each dimension: the last crops are shifted back to the image border,
+# so that the whole image is covered
+rows, cols = tiling.tile_offsets(height, width, crop_size, stride)
 
 # Crop and save images
-for i in range(num_crops_h):
-    for j in range(num_crops_w):
-        # Calculate coordinates for cropping
-        left = j * crop_size
-        top = i * crop_size
-        right = left + crop_size
-        bottom = top + crop_size
-        
+for i, top in enumerate(rows):
+    # rows of this line of crops
+    band = reader.read_rows(top, crop_size)
+    for j, left in enumerate(cols):
         # Crop the image
-        cropped = img.crop((left, top, right, bottom))
+        cropped = Image.fromarray(band[:, left:left + crop_size].squeeze(-1) if band.shape[-1] == 1
+                                  else band[:, left:left + crop_size])
         
         # Save as .tif
         output_path = os.path.join(output_dir, f"crop_{i}_{j}.png")
         cropped.save(output_path, format='png')
+reader.close()
 
-print(f"Finished cropping! Created {num_crops_w * num_crops_h} images of size {crop_size}x{crop_size}")
+print(f"Finished cropping! Created {len(rows) * len(cols)} images of size {crop_size}x{crop_size}")
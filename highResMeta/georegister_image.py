@@ -1,8 +1,12 @@
 from osgeo import gdal, osr
 import numpy as np
-from PIL import Image
 from xml.etree import ElementTree as ET
 import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from raster_io import WindowedReader
 
 def parse_kml_coordinates(kml_path):
     """Parse KML file and return coordinates."""
@@ -25,18 +29,18 @@ def parse_kml_coordinates(kml_path):
 def create_geotiff(image_path, kml_path, output_path):
     """
     Create a georeferenced TIFF from the input image using KML coordinates.
+    The image is copied by strips of rows, so it never needs to fit in memory.
     
     Args:
         image_path: Path to the input image
         kml_path: Path to the KML file containing coordinates
         output_path: Path where the GeoTIFF will be saved
     """
-    # Read the image
-    img = Image.open(image_path)
-    img_array = np.array(img)
+    # Open the image
+    reader = WindowedReader(image_path, read_ahead=1)
     
     # Get image dimensions
-    height, width = img_array.shape[:2]
+    height, width, bands = reader.shape
     
     # Parse KML coordinates
     lons, lats = parse_kml_coordinates(kml_path)
@@ -55,7 +59,6 @@ def create_geotiff(image_path, kml_path, output_path):
     
     # Create the GeoTIFF
     driver = gdal.GetDriverByName('GTiff')
-    bands = img_array.shape[2] if len(img_array.shape) > 2 else 1
     
     dataset = driver.Create(
         output_path,
@@ -74,15 +77,14 @@ def create_geotiff(image_path, kml_path, output_path):
     srs.ImportFromEPSG(4326)  # WGS84
     dataset.SetProjection(srs.ExportToWkt())
     
-    # Write the data
-    if bands == 1:
-        dataset.GetRasterBand(1).WriteArray(img_array)
-    else:
+    # Write the data, strip by strip
+    for row, strip in reader.iter_strips():
         for band in range(bands):
-            dataset.GetRasterBand(band + 1).WriteArray(img_array[:, :, band])
+            dataset.GetRasterBand(band + 1).WriteArray(strip[:, :, band], 0, row)
     
     # Close the dataset
     dataset = None
+    reader.close()
     
     print(f"GeoTIFF created successfully at: {output_path}")
     print(f"Spatial extent: {min_lon}, {min_lat}, {max_lon}, {max_lat}")
@@ -1,8 +1,13 @@
 import os
+import sys
+from pathlib import Path
 import numpy as np
 from PIL import Image
 import matplotlib.pyplot as plt
 
+sys.path.append(str(Path(__file__).parent.parent))
+import tiling
+
 # Original image path to get dimensions
 original_img_path = "highResMeta/SiteC.png"
 original_img = Image.open(original_img_path)
@@ -11,33 +16,49 @@ original_width, original_height = original_img.size
 # Directory containing the CHM prediction files (.npy)
 prediction_dir = "output"  # Change this to your prediction directory
 crop_size = 256
+# Stride of generate_256_256_crop.py: overlapping predictions are blended with a Hann window
+stride = 256
+
+# Optional georeferenced output (needs GDAL), written by strips of rows as the merge goes,
+# e.g. "merged_CHM_satellite.tif". By default only merged_CHM.npy is saved
+kml_path = "highResMeta/kml.kml"
+output_tiff = None
+
+# Merged result, written by strips of rows into a memory mapped .npy file
+sink = tiling.ArraySink(original_height, original_width, path="merged_CHM.npy")
+writer = None
+if output_tiff:
+    from create_georeferenced_tiff import open_geotiff
+    writer = open_geotiff(kml_path, output_tiff, original_width, original_height)
 
-# Create empty array for the merged result
-merged_chm = np.zeros((original_height, original_width))
+def write_strip(row, block):
+    sink(row, block)
+    if writer is not None:
+        writer.write(block, row)
 
-# Calculate number of crops in each dimension
-num_crops_w = original_width // crop_size
-num_crops_h = original_height // crop_size
+merger = tiling.BlendMerger(original_height, original_width, crop_size, sink=write_strip, window='hann')
+
+# Offsets of the crops in each dimension, as in generate_256_256_crop.py: the whole image is covered
+rows, cols = tiling.tile_offsets(original_height, original_width, crop_size, stride)
 
 # Merge predictions
-for i in range(num_crops_h):
-    for j in range(num_crops_w):
+for i, top in enumerate(rows):
+    for j, left in enumerate(cols):
         # Load the prediction file
         pred_path = os.path.join(prediction_dir, f"crop_{i}_{j}.npy")
         if os.path.exists(pred_path):
             pred = np.load(pred_path)
             
-            # Calculate positions
-            top = i * crop_size
-            left = j * crop_size
-            
-            # Place the prediction in the merged array
-            merged_chm[top:top+crop_size, left:left+crop_size] = pred
-
-# Save the merged result
-np.save("merged_CHM.npy", merged_chm)
+            # Accumulate the prediction in the merged array
+            merger.add(pred, top, left)
+merger.close()
+merged_chm = sink.array
+merged_chm.flush()
 
 print(f"Merged CHM saved with shape: {merged_chm.shape}")
+if writer is not None:
+    writer.close()
+    print(f"Created georeferenced TIFF file: {output_tiff}")
 
 # Visualize the merged CHM
 plt.figure(figsize=(12, 8))
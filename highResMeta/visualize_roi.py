@@ -5,6 +5,11 @@ import os
 import numpy as np
 from matplotlib_scalebar.scalebar import ScaleBar
 import math
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from raster_io import WindowedReader
 
 def parse_kml_coordinates(kml_path):
     """Parse KML file and return coordinates."""
@@ -43,7 +48,7 @@ def calculate_distance_meters(lon1, lat1, lon2, lat2):
     
     return R * c
 
-def visualize_boundaries(image_path, reference_kml, roi_kml, output_path="tmp/roi_visualization.png"):
+def visualize_boundaries(image_path, reference_kml, roi_kml, output_path="tmp/roi_visualization.png", max_size=4096):
     """
     Visualize the ROI boundary on the image with a scale bar.
     
@@ -52,6 +57,7 @@ def visualize_boundaries(image_path, reference_kml, roi_kml, output_path="tmp/ro
         reference_kml: Path to the reference KML file (used for GPS alignment)
         roi_kml: Path to the ROI KML file to be visualized
         output_path: Path where the output image will be saved
+        max_size: The image is read decimated to at most max_size pixels per side
     """
     # Create output directory if it doesn't exist
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
@@ -67,11 +73,14 @@ def visualize_boundaries(image_path, reference_kml, roi_kml, output_path="tmp/ro
     img_width_meters = calculate_distance_meters(min_lon, (min_lat + max_lat)/2,
                                                max_lon, (min_lat + max_lat)/2)
     
-    # Read the image
-    img = plt.imread(image_path)
+    # Read the image, decimated: the figure does not need more pixels
+    with WindowedReader(image_path) as reader:
+        img = reader.read_decimated(max_size)
+    if img.shape[-1] == 1:
+        img = img[:, :, 0]
     img_height, img_width = img.shape[:2]
     
-    # Calculate meters per pixel
+    # Calculate meters per pixel (of the decimated image)
     meters_per_pixel = img_width_meters / img_width
     
     # Create figure and axis
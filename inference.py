@@ -4,7 +4,13 @@
 # found in the LICENSE file in the root directory of this source tree.
 
 import argparse
+import hashlib
+import inspect
+import json
 import os
+import warnings
+import zipfile
+from collections import OrderedDict
 import torch
 import pandas as pd
 import numpy as np
@@ -21,12 +27,57 @@ import torchvision
 from torchvision.utils import save_image
 
 from models.backbone import SSLVisionTransformer
-from models.dpt_head import DPTHead
+from models.dpt_head import DPTHead, prepare_static_quantization, convert_static_quantization
 import pytorch_lightning as pl
 from models.regressor import RNet
 
+# normalization of the images going through the encoder
+NORM_MEAN = (0.420, 0.411, 0.296)
+NORM_STD = (0.213, 0.156, 0.143)
+
+def load_checkpoint(path, mmap=False, map_location=None):
+    """torch.load, optionally memory mapping the file (torch >= 2.1). Memory
+    mapped tensors live in copy-on-write pages of the page cache, so processes
+    of a host loading the same file share one physical copy of the weights."""
+    if mmap and 'mmap' in inspect.signature(torch.load).parameters:
+        try:
+            return torch.load(path, map_location=map_location, mmap=True)
+        except RuntimeError as e:
+            # e.g. checkpoints saved in the legacy (non zip) format
+            warnings.warn(f'cannot memory map {path} ({e}), loading it in memory')
+    elif mmap:
+        warnings.warn(f'torch {torch.__version__} cannot memory map checkpoints, loading {path} in memory')
+    return torch.load(path, map_location=map_location)
+
+def load_weights(module, state_dict, strict=True, assign=False):
+    """load_state_dict, optionally keeping the checkpoint tensors as the module
+    parameters instead of copying them (torch >= 2.1), so memory mapped
+    weights stay shared. Quantized layers always repack their weights."""
+    if assign and 'assign' in inspect.signature(module.load_state_dict).parameters:
+        return module.load_state_dict(state_dict, strict=strict, assign=True)
+    return module.load_state_dict(state_dict, strict=strict)
+
+def load_normnet(path, mmap=False, optimize=False, quantize_fc=False):
+    """RNet predicting the p5 and p95 quantiles used to normalize aerial images.
+    With optimize, BatchNorms are folded into the convolutions and these run in
+    channels last memory format; quantize_fc also makes the fully connected
+    layers dynamic int8, see RNet.optimize_for_inference."""
+    ckpt = load_checkpoint(path, mmap=mmap, map_location='cpu')
+    state_dict = ckpt['state_dict']
+    for k in list(state_dict.keys()):
+        if 'backbone.' in k:
+            new_k = k.replace('backbone.','')
+            state_dict[new_k] = state_dict.pop(k)
+
+    model_norm = RNet(n_classes=6)
+    model_norm = model_norm.eval()
+    load_weights(model_norm, state_dict, assign=mmap)
+    if optimize or quantize_fc:
+        model_norm.optimize_for_inference(quantize_fc=quantize_fc)
+    return model_norm
+
 class SSLAE(nn.Module):
-    def __init__(self, pretrained=None, classify=True, n_bins=256, huge=False):
+    def __init__(self, pretrained=None, classify=True, n_bins=256, huge=False, **backbone_kwargs):
         super().__init__()
         if huge == True:
             self.backbone = SSLVisionTransformer(
@@ -34,7 +85,8 @@ class SSLAE(nn.Module):
             num_heads=20,
             out_indices=(9, 16, 22, 29),
             depth=32,
-            pretrained=pretrained
+            pretrained=pretrained,
+            **backbone_kwargs
             )
             self.decode_head = DPTHead(
                 classify=classify,
@@ -43,52 +95,307 @@ class SSLAE(nn.Module):
                 post_process_channels=[160, 320, 640, 1280],
             )  
         else:
-            self.backbone = SSLVisionTransformer(pretrained=pretrained)
+            self.backbone = SSLVisionTransformer(pretrained=pretrained, **backbone_kwargs)
             self.decode_head = DPTHead(classify=classify,n_bins=256)
         
-    def forward(self, x):
-        x = self.backbone(x)
+    def forward(self, x, affine=None):
+        x = self.backbone(x, affine)
         x = self.decode_head(x) 
         return x
 
 class SSLModule(pl.LightningModule):
     def __init__(self, 
-                  ssl_path="compressed_SSLbaseline.pth"):
+                  ssl_path="compressed_SSLbaseline.pth",
+                  attn_backend='math',
+                  attn_chunk_size=256,
+                  inference_only=False,
+                  token_merging=0,
+                  mmap=False,
+                  fold_norm=False,
+                  uncertainty=False,
+                  fast_topology=False,
+                  inplace=True):
         super().__init__()
+        backbone_kwargs = dict(attn_backend=attn_backend, attn_chunk_size=attn_chunk_size,
+                               inference_only=inference_only, token_merging=token_merging)
     
         if 'huge' in ssl_path:
-            self.chm_module_ = SSLAE(classify=True, huge=True).eval()
+            self.chm_module_ = SSLAE(classify=True, huge=True, **backbone_kwargs).eval()
         else:
-            self.chm_module_ = SSLAE(classify=True, huge=False).eval()
+            self.chm_module_ = SSLAE(classify=True, huge=False, **backbone_kwargs).eval()
         
         if 'compressed' in ssl_path:   
-            ckpt = torch.load(ssl_path, map_location='cpu')
-            self.chm_module_ = torch.quantization.quantize_dynamic(
-                self.chm_module_, 
-                {torch.nn.Linear,torch.nn.Conv2d,  torch.nn.ConvTranspose2d},
-                dtype=torch.qint8)
-            self.chm_module_.load_state_dict(ckpt, strict=False)
+            ckpt = load_checkpoint(ssl_path, mmap=mmap, map_location='cpu')
+            if ckpt.get('quantization') == 'static_head':
+                # int8 decoder convolutions, see quantize_static_head; they run on the engine they were
+                # calibrated for, as in load_artifact
+                if ckpt['backend'] in torch.backends.quantized.supported_engines:
+                    torch.backends.quantized.engine = ckpt['backend']
+                with warnings.catch_warnings():
+                    # the observers are not run: scales and zero points come from the checkpoint
+                    warnings.filterwarnings('ignore', message='must run observer before calling calculate_qparams')
+                    quantize_static_head(self.chm_module_, backend=ckpt['backend'])
+                load_weights(self.chm_module_, ckpt['state_dict'], assign=mmap)
+            else:
+                self.chm_module_ = torch.quantization.quantize_dynamic(
+                    self.chm_module_, 
+                    {torch.nn.Linear,torch.nn.Conv2d,  torch.nn.ConvTranspose2d},
+                    dtype=torch.qint8)
+                # the float tensors (convolutions, embeddings, norms) stay memory mapped
+                load_weights(self.chm_module_, ckpt, strict=False, assign=mmap)
+            # int8 readout projections split into patch and cls halves, see ReassembleBlocks.project_readout
+            self.chm_module_.decode_head.reassemble_blocks.split_readout_projects()
         else:
-            ckpt = torch.load(ssl_path)
+            ckpt = load_checkpoint(ssl_path, mmap=mmap)
             state_dict = ckpt['state_dict']
-            self.chm_module_.load_state_dict(state_dict)
+            load_weights(self.chm_module_, state_dict, assign=mmap)
+        
+        # fold T.Normalize(NORM_MEAN, NORM_STD) into the patch embedding: takes unnormalized images
+        self.fold_norm = fold_norm
+        if fold_norm:
+            self.chm_module_.backbone.patch_embed.fold_input_affine(NORM_MEAN, NORM_STD)
         
-        self.chm_module = lambda x: 10*self.chm_module_(x)
-    def forward(self, x):
-        x = self.chm_module(x)
+        # also output standard deviation and quantiles of the heights, see DPTHead.decode_bins
+        self.chm_module_.decode_head.uncertainty = uncertainty
+        self.chm_module_.decode_head.set_fast_topology(fast_topology)
+        # in place residuals and activations without autograd (e.g. in evaluate),
+        # same predictions with fewer allocations
+        self.chm_module_.decode_head.set_inplace(inplace)
+        
+        self.chm_module = lambda x, affine=None: 10*self.chm_module_(x, affine)
+    def forward(self, x, affine=None):
+        """affine: optional per image, per channel (scale, shift) of shape (B, 3)
+        applied to the images before the patch embedding, see PatchEmbed."""
+        x = self.chm_module(x, affine)
         return x
 
+def quantize_static_head(model, calibration_batches=(), backend=None):
+    """Quantize a float SSLAE in place: dynamic int8 quantization of the Linear
+    layers (as in the compressed checkpoints), plus static int8 quantization
+    of the decoder convolutions, whose activation ranges are calibrated on
+    `calibration_batches` of normalized images. Without calibration batches
+    only the quantized structure is built, to load a static_head checkpoint.
+    """
+    backend = backend or torch.backends.quantized.engine
+    torch.quantization.quantize_dynamic(model.backbone, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    prepare_static_quantization(model.decode_head, backend=backend)
+    with torch.no_grad():
+        for x in calibration_batches:
+            model(x)
+    convert_static_quantization(model.decode_head)
+    torch.quantization.quantize_dynamic(model.decode_head, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+ARTIFACT_METADATA = 'metadata.json'
+
+def is_artifact(path):
+    """True if path is a TorchScript model written by `export.py --artifact`."""
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as f:
+        return any(name.endswith('extra/' + ARTIFACT_METADATA) for name in f.namelist())
+
+def load_artifact(path, map_location='cpu'):
+    """Load a model exported by `export.py --artifact`. Returns the TorchScript
+    module, which maps normalized images to canopy height in meters like
+    SSLModule, and its metadata (variant, tile size, normalization, ...).
+    Switches to the quantized engine the artifact was exported with."""
+    extra_files = {ARTIFACT_METADATA: ''}
+    model = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    metadata = json.loads(extra_files[ARTIFACT_METADATA])
+    engine = metadata.get('quantized_engine')
+    if engine in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = engine
+    return model.eval(), metadata
+
+def load_png_tiles(path, n_tiles=None):
+    """(n, 3, H, W) batch of the png tiles of a directory, in name order."""
+    names = sorted(x for x in os.listdir(path) if x.endswith('.png'))[:n_tiles]
+    return torch.stack([TF.to_tensor(Image.open(os.path.join(path, x)).convert('RGB')) for x in names])
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """Batch sampler grouping tiles of heterogeneous sizes into shape buckets.
+    Tile sizes are rounded up to a multiple of `granularity` (a multiple of 32,
+    so that the decoder output matches the padded input), and each batch only
+    holds tiles of a single bucket, to be padded to the bucket shape by
+    `pad_collate`.
+    Args:
+        sizes (list): (height, width) of each sample of the dataset.
+        batch_size (int): maximum number of tiles per batch.
+        granularity (int): bucket size step in pixels. Default: 64.
+        shuffle (bool): shuffle tiles within buckets and the order of batches.
+        drop_last (bool): drop the last incomplete batch of each bucket.
+    """
+    def __init__(self, sizes, batch_size, granularity=64, shuffle=False, drop_last=False):
+        self.sizes = list(sizes)
+        self.batch_size = batch_size
+        self.granularity = granularity
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.buckets = {}
+        for i, (h, w) in enumerate(self.sizes):
+            self.buckets.setdefault(bucket_shape((h, w), granularity), []).append(i)
+
+    def _num_batches(self, n):
+        return n // self.batch_size if self.drop_last else math.ceil(n / self.batch_size)
+
+    def __iter__(self):
+        batches = []
+        for indices in self.buckets.values():
+            if self.shuffle:
+                indices = [indices[i] for i in torch.randperm(len(indices))]
+            for b in range(self._num_batches(len(indices))):
+                batches.append(indices[b * self.batch_size:(b + 1) * self.batch_size])
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches))]
+        return iter(batches)
+
+    def __len__(self):
+        return sum(self._num_batches(len(indices)) for indices in self.buckets.values())
+
+    def padding_report(self):
+        """Number of tiles, batches and fraction of padded pixels per bucket shape."""
+        report = {}
+        for (bh, bw), indices in sorted(self.buckets.items()):
+            valid = sum(self.sizes[i][0] * self.sizes[i][1] for i in indices)
+            report[(bh, bw)] = dict(tiles=len(indices),
+                                    batches=self._num_batches(len(indices)),
+                                    padding=1 - valid / (bh * bw * len(indices)))
+        return report
+
+def bucket_shape(size, granularity=64):
+    h, w = size
+    return (math.ceil(h / granularity) * granularity, math.ceil(w / granularity) * granularity)
+
+def pad_collate(batch, granularity=64, fill=NORM_MEAN):
+    """Collate (img, *fields) samples of different sizes, as batched by
+    BucketBatchSampler. Images are padded at the bottom right to their bucket
+    shape with the per channel `fill` value, which is zero once normalized by
+    NORM_MEAN. Returns (imgs, sizes, *fields) with the (height, width) of each
+    image in `sizes`, to crop the predictions."""
+    imgs = [item[0] for item in batch]
+    sizes = torch.tensor([img.shape[-2:] for img in imgs])
+    h, w = bucket_shape(sizes.max(dim=0).values.tolist(), granularity)
+    out = torch.empty(len(imgs), imgs[0].shape[0], h, w, dtype=imgs[0].dtype)
+    out[:] = torch.tensor(fill, dtype=out.dtype)[:, None, None]
+    for i, img in enumerate(imgs):
+        out[i, :, :img.shape[-2], :img.shape[-1]] = img
+    fields = torch.utils.data.default_collate([item[1:] for item in batch])
+    return (out, sizes, *fields)
+
+class SceneBatchSampler(torch.utils.data.Sampler):
+    """Batch sampler keeping each DataLoader worker on the crops of the same
+    scenes, so that with a per worker image cache (see ImageCache) each scene
+    is decoded by a single worker, about once per epoch. The DataLoader hands
+    batch i to worker i % num_workers: scenes are dealt to the workers with
+    the fewest crops so far, each worker's crops are cut into batches at
+    scene boundaries, and the largest batches of the workers with fewer
+    batches are split in two, so that every worker gets the same number of
+    batches and batch i always belongs to the crops of worker i % num_workers.
+    This holds as long as every worker has at least that many crops, e.g.
+    when there are at least as many scenes as workers.
+    Args:
+        scenes (list): scene of each sample of the dataset.
+        batch_size (int): maximum number of crops per batch.
+        num_workers (int): num_workers of the DataLoader. Default: 1.
+        shuffle (bool): shuffle the scenes of each worker and the crops
+            within each scene.
+    """
+    def __init__(self, scenes, batch_size, num_workers=1, shuffle=False):
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.shuffle = shuffle
+        self.scenes = OrderedDict()
+        for i, scene in enumerate(scenes):
+            self.scenes.setdefault(scene, []).append(i)
+        # scenes of each worker, fixed so that the number of batches is too
+        self.worker_scenes = [[] for _ in range(self.num_workers)]
+        crops = [0] * self.num_workers
+        for indices in sorted(self.scenes.values(), key=len, reverse=True):
+            w = crops.index(min(crops))
+            self.worker_scenes[w].append(indices)
+            crops[w] += len(indices)
+
+    def _streams(self, shuffle):
+        streams = []
+        for scenes in self.worker_scenes:
+            if shuffle:
+                scenes = [scenes[i] for i in torch.randperm(len(scenes))]
+            stream = []
+            for indices in scenes:
+                if shuffle:
+                    indices = [indices[i] for i in torch.randperm(len(indices))]
+                stream.extend(indices[b:b + self.batch_size] for b in range(0, len(indices), self.batch_size))
+            streams.append(stream)
+        n_batches = max(len(stream) for stream in streams)
+        for stream in streams:
+            while len(stream) < n_batches:
+                i = max(range(len(stream)), key=lambda i: len(stream[i]), default=None)
+                if i is None or len(stream[i]) < 2:
+                    break
+                half = len(stream[i]) // 2
+                stream[i:i + 1] = [stream[i][:half], stream[i][half:]]
+        # a worker short of batches must come last, its missing batches ending the iteration
+        return sorted(streams, key=len, reverse=True)
+
+    def __iter__(self):
+        streams = self._streams(self.shuffle)
+        for b in range(max(len(s) for s in streams)):
+            for s in streams:
+                if b < len(s):
+                    yield s[b]
+
+    def __len__(self):
+        return sum(len(s) for s in self._streams(shuffle=False))
+
+# numpy dtypes TF.to_tensor gives to PIL images: only 8 bit images are scaled to [0, 1]
+PIL_MODE_DTYPES = {'I': np.int32, 'I;16': np.int16, 'F': np.float32}
+
+class ImageCache:
+    """LRU cache of decoded images within a budget of max_bytes, kept as
+    (H, W[, C]) arrays of their native dtype (uint8 for 8 bit images, 4x
+    smaller than float tensors): crop them and convert the crops with
+    TF.to_tensor, see crop. Each DataLoader worker holds its own copy."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.images = OrderedDict()
+
+    def __call__(self, path):
+        if path in self.images:
+            self.images.move_to_end(path)
+            return self.images[path]
+        img = Image.open(path)
+        if img.mode == '1':
+            img = img.convert('L')
+        img = np.asarray(img, dtype=PIL_MODE_DTYPES.get(img.mode, np.uint8))
+        if img.nbytes <= self.max_bytes:
+            while self.nbytes + img.nbytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+            self.images[path] = img
+            self.nbytes += img.nbytes
+        return img
+
+    def crop(self, path, x, y, size):
+        """(C, size, size) tensor of the crop at (x, y), as TF.to_tensor of the image."""
+        # copied: the tensor must not share the memory of the cached image
+        return TF.to_tensor(self(path)[y:y + size, x:x + size].copy())
+
 class NeonDataset(torch.utils.data.Dataset):
     path = './data/images/'
     root_dir = Path(path)
     df_path = './data/neon_test_data.csv'
     
-    def __init__(self, model_norm, new_norm, src_img='maxar', 
-                 trained_rgb= False, no_norm = False,
+    def __init__(self, new_norm=True, src_img='maxar', 
+                 trained_rgb= False, no_norm = False, image_cache_mb=0,
                 **kwargs):
        
+        # decoded source images, chms and reference images: each is cropped 36 times.
+        # image_cache_mb is the budget of each DataLoader worker
+        self.image_cache = ImageCache(image_cache_mb * 2**20)
+        # images are returned unnormalized: aerial images are normalized per batch by normalize_batch
         self.no_norm = no_norm
-        self.model_norm = model_norm
         self.new_norm = new_norm
         self.trained_rgb = trained_rgb
         self.size = 256
@@ -102,6 +409,10 @@ class NeonDataset(torch.utils.data.Dataset):
         if self.src_img == 'neon':
             return 30 * len(self.df) 
         return len(self.df)
+    
+    def scenes(self):
+        """Scene of each crop, for SceneBatchSampler."""
+        return [i // self.size_multiplier**2 for i in range(len(self))]
         
 
     def __getitem__(self, i):      
@@ -111,42 +422,199 @@ class NeonDataset(torch.utils.data.Dataset):
             l = self.df.iloc[ix]
         x = list(range(l.bord_x, l.imsize-l.bord_x-self.size, self.size))[jx]
         y = list(range(l.bord_y, l.imsize-l.bord_y-self.size, self.size))[jy]  
-        img = TF.to_tensor(Image.open(self.root_dir / l[self.src_img]).crop((x, y, x+self.size, y+self.size)))
-        chm = TF.to_tensor(Image.open(self.root_dir / l.chm).crop((x, y, x+self.size, y+self.size)))
+        img = self.image_cache.crop(self.root_dir / l[self.src_img], x, y, self.size)
+        chm = self.image_cache.crop(self.root_dir / l.chm, x, y, self.size)
         chm[chm<0] = 0
         
-        if not self.trained_rgb:
-            if self.src_img == 'neon':
-                if self.no_norm:
-                    normIn = img
-                else:
-                    if self.new_norm:
-                        # image image normalization using learned quantiles of pairs of Maxar/Neon images
-                        x = torch.unsqueeze(img, dim=0)
-                        norm_img = self.model_norm(x).detach()
-                        p5I = [norm_img[0][0].item(), norm_img[0][1].item(), norm_img[0][2].item()]
-                        p95I = [norm_img[0][3].item(), norm_img[0][4].item(), norm_img[0][5].item()]
-                    else:
-                        # apply image normalization to aerial images, matching color intensity of maxar images
-                        I = TF.to_tensor(Image.open(self.root_dir / l['maxar']).crop((x, y, x+s, y+s))) 
-                        p5I = [np.percentile(I[i,:,:].flatten(),5) for i in range(3)]
-                        p95I = [np.percentile(I[i,:,:].flatten(),95) for i in range(3)]
-                    p5In = [np.percentile(img[i,:,:].flatten(),5) for i in range(3)]
-
-                    p95In = [np.percentile(img[i,:,:].flatten(),95) for i in range(3)]
-                    normIn = img.clone()
-                    for i in range(3):
-                        normIn[i,:,:] = (img[i,:,:]-p5In[i]) * ((p95I[i]-p5I[i])/(p95In[i]-p5In[i])) + p5I[i]
-                  
-        return {'img': normIn, 
-                'img_no_norm': img, 
+        item = {'img': img, 
                 'chm': chm,
                 'lat':torch.Tensor([l.lat]).nan_to_num(0),
                 'lon':torch.Tensor([l.lon]).nan_to_num(0),
                }
+        # scene of the crop, see SceneQuantileCache
+        item['scene'] = ix
+        if self.src_img == 'neon' and not self.trained_rgb and not self.no_norm and not self.new_norm:
+            # maxar image at the same coordinates, whose intensities the aerial image is matched to
+            item['ref_img'] = self.image_cache.crop(self.root_dir / l['maxar'], x, y, self.size)
+        return item
+
+def percentiles(img, q, levels=None):
+    """Percentiles q (in [0, 100]) of each channel of the (B, C, H, W) images,
+    with the linear interpolation of np.percentile, as a (len(q), B, C) tensor.
+    All images and channels are sorted at once. Integer images, and float
+    images holding k / (levels - 1) values such as the 8 bit images read by
+    TF.to_tensor (levels=256), use an exact histogram instead: one bincount
+    over the batch, linear in the number of pixels."""
+    B, C = img.shape[:2]
+    values = img.reshape(B * C, -1)
+    N = values.shape[1]
+    pos = torch.tensor([p / 100 * (N - 1) for p in q], dtype=torch.float64, device=img.device)
+    low = pos.floor().long()
+    high = (low + 1).clamp(max=N - 1)
+    frac = (pos - low).to(torch.float32 if not img.is_floating_point() else img.dtype)
+    if levels is None and img.is_floating_point():
+        values = values.sort(dim=1).values
+        v_low, v_high = values[:, low], values[:, high]
+    else:
+        scale = 1 if levels is None else levels - 1
+        levels = levels or int(values.max()) + 1
+        values = (values * scale).round().long() if img.is_floating_point() else values.long()
+        offsets = torch.arange(B * C, device=img.device)[:, None] * levels
+        counts = torch.bincount((values + offsets).flatten(), minlength=B * C * levels)
+        cdf = counts.view(B * C, levels).cumsum(dim=1)
+        # the k-th smallest value (from 0) is the first level whose cumulative count exceeds k
+        v_low = torch.searchsorted(cdf, low.expand(B * C, -1).contiguous(), right=True) / scale
+        v_high = torch.searchsorted(cdf, high.expand(B * C, -1).contiguous(), right=True) / scale
+    out = torch.lerp(v_low.to(frac.dtype), v_high.to(frac.dtype), frac)
+    return out.t().reshape(len(q), B, C)
+
+def aerial_affine(img, model_norm=None, ref_img=None, levels=None):
+    """Per image, per channel (scale, shift) of shape (B, 3) mapping the 5th and
+    95th percentiles of each channel of the (B, 3, H, W) aerial images onto the
+    ones of the reference satellite images ref_img (normtype 1), or onto the
+    ones predicted by model_norm in one batched call (normtype 2). See
+    percentiles for levels."""
+    if ref_img is not None:
+        p5I, p95I = percentiles(ref_img, (5, 95), levels=levels)
+    else:
+        # model_norm stays on CPU when its fully connected layers are int8
+        device = next(model_norm.parameters()).device
+        with torch.no_grad():
+            quantiles = model_norm(img.to(device)).to(img.device)
+        p5I, p95I = quantiles[:, :3], quantiles[:, 3:6]
+    p5In, p95In = percentiles(img, (5, 95), levels=levels)
+    return percentile_affine(p5I, p95I, p5In, p95In)
+
+def percentile_affine(p5I, p95I, p5In, p95In):
+    """(scale, shift) mapping the percentiles p5In, p95In onto p5I, p95I."""
+    scale = (p95I - p5I) / (p95In - p5In)
+    return scale, p5I - p5In * scale
+
+def file_hash(path, chunk_size=2**20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class SceneQuantileCache:
+    """Normalization percentiles of whole aerial scenes, computed once per scene
+    and kept in a small on disk cache (one json file per scene), so that all
+    the tiles of a scene share them. This also removes the color seams between
+    tiles normalized independently.
+    For a scene, returns a (4, 3) tensor of per channel p5I, p95I (targets)
+    and p5In, p95In (of the scene). The targets are the percentiles of the
+    satellite reference scene when given (normtype 1), otherwise the mean of
+    the predictions of model_norm on a grid of up to n_tiles tiles of the
+    scene (normtype 2). Scenes are read through raster_io.WindowedReader: the
+    percentiles are the ones of their view decimated to decimated_size
+    pixels, and only the tiles are read at full resolution. Entries are keyed
+    by the identity of the images (path, size, modification time), the sha256
+    of the normnet checkpoint and its RNet.variant (float, or optimized with
+    int8 fully connected layers)."""
+    def __init__(self, cache_dir, model_norm=None, normnet_path=None, n_tiles=16, tile_size=256,
+                 decimated_size=2048):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.model_norm = model_norm
+        self.normnet_hash = file_hash(normnet_path) if normnet_path is not None else None
+        self.normnet_variant = getattr(model_norm, 'variant', 'float')
+        self.n_tiles = n_tiles
+        self.tile_size = tile_size
+        self.decimated_size = decimated_size
+
+    @staticmethod
+    def image_id(path):
+        stat = os.stat(path)
+        return f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    def key(self, path, ref_path=None):
+        if ref_path is not None:
+            target = 'ref:' + self.image_id(ref_path)
+        else:
+            assert self.normnet_hash is not None, 'normnet_path is needed to cache predicted quantiles'
+            target = f'normnet:{self.normnet_hash}:{self.normnet_variant}:{self.n_tiles}:{self.tile_size}'
+        return hashlib.sha1(f'{self.image_id(path)}:{self.decimated_size}|{target}'.encode()).hexdigest()
+
+    def __call__(self, path, ref_path=None):
+        cache_file = self.cache_dir / (self.key(path, ref_path) + '.json')
+        if cache_file.exists():
+            with open(cache_file) as f:
+                return torch.tensor(json.load(f)['quantiles'])
+        quantiles = self.compute(path, ref_path)
+        # written atomically: workers may fill the cache concurrently
+        tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump({'image': str(path), 'ref_image': str(ref_path), 'quantiles': quantiles.tolist()}, f)
+        os.replace(tmp_file, cache_file)
+        return quantiles
+
+    def compute(self, path, ref_path=None):
+        # scenes are read by windows through GDAL, never decoded whole
+        from raster_io import WindowedReader
+        with WindowedReader(path, bands=3) as scene:
+            p5In, p95In = self.percentiles(scene)
+            if ref_path is None:
+                tiles = self.sample_tiles(scene)
+        if ref_path is not None:
+            with WindowedReader(ref_path, bands=3) as ref:
+                p5I, p95I = self.percentiles(ref)
+        else:
+            device = next(self.model_norm.parameters()).device
+            with torch.no_grad():
+                quantiles = self.model_norm(tiles.to(device)).mean(dim=0, keepdim=True).cpu()
+            p5I, p95I = quantiles[:, :3], quantiles[:, 3:6]
+        return torch.cat((p5I, p95I, p5In, p95In))
+
+    def percentiles(self, reader):
+        """p5, p95 of a scene, on its view decimated to decimated_size pixels."""
+        from tiling import to_tensor
+        img = to_tensor(reader.read_decimated(self.decimated_size)[None])
+        return percentiles(img, (5, 95), levels=256 if reader.dtype == np.uint8 else None)
+
+    def sample_tiles(self, reader):
+        """(n, 3, tile_size, tile_size) grid of up to n_tiles tiles of a
+        scene, edge padded when the scene is smaller than a tile."""
+        from tiling import pad_tile, to_tensor
+        k = math.ceil(math.sqrt(self.n_tiles))
+        H, W = reader.shape[:2]
+        rows = torch.linspace(0, max(H - self.tile_size, 0), k).long().unique().tolist()
+        cols = torch.linspace(0, max(W - self.tile_size, 0), k).long().unique().tolist()
+        tiles = [pad_tile(reader.read(c, r, min(self.tile_size, W - c), min(self.tile_size, H - r)), self.tile_size)
+                 for r in rows for c in cols]
+        return to_tensor(np.stack(tiles))
 
-def evaluate(model, 
-             norm, 
+def normalize_batch(batch, model_norm=None, fold_affine=False, scene_quantiles=None):
+    """Normalize the aerial images of a collated NeonDataset batch in place,
+    matching the intensities of satellite images: their 5th and 95th
+    percentiles are mapped onto the ones of the maxar images at the same
+    coordinates ('ref_img', normtype 1) or onto the ones predicted by
+    model_norm in one batched call (normtype 2). The rescale is one broadcast
+    op over the batch. With fold_affine, the images are left unchanged and the
+    (B, 2, 3) per channel scale and shift are added as 'affine', to be applied
+    by the model (see SSLModule.forward). Without reference nor model_norm
+    (normtype 0) the batch is unchanged, with no 'affine'. scene_quantiles, a
+    (n_scenes, 4, 3) tensor of SceneQuantileCache entries indexed by 'scene',
+    replaces the per image percentiles by the ones of their scene."""
+    img = batch['img']
+    batch['img_no_norm'] = img
+    if scene_quantiles is not None:
+        scale, shift = percentile_affine(*scene_quantiles[batch['scene']].unbind(dim=1))
+    elif 'ref_img' in batch or model_norm is not None:
+        scale, shift = aerial_affine(img, model_norm, batch.get('ref_img'))
+    else:
+        return batch
+    if fold_affine:
+        batch['affine'] = torch.stack((scale, shift), dim=1)
+    else:
+        batch['img'] = torch.addcmul(shift[:, :, None, None], img, scale[:, :, None, None])
+    return batch
+
+# without autograd: the decoder decodes the bins in place (see DPTHead.decode_bins)
+# and no activation is kept for a backward pass
+@torch.no_grad()
+def evaluate(model,
+             norm,
              model_norm,
              name, 
              bs=32, 
@@ -154,7 +622,11 @@ def evaluate(model,
              normtype=2,
              device = 'cuda:0', 
              no_norm = False, 
-             display = False):
+             display = False,
+             quantile_cache = None,
+             normnet_path = None,
+             num_workers = 10,
+             image_cache_mb = 256):
       
     dataset_key = 'neon_aerial'
     
@@ -176,8 +648,24 @@ def evaluate(model,
     elif normtype == 2:
         new_norm=True
     
-    ds = NeonDataset( model_norm, new_norm, domain='test', src_img='neon', trained_rgb=trained_rgb, no_norm=no_norm)
-    dataloader = torch.utils.data.DataLoader(ds, batch_size=bs, shuffle=True, num_workers=10)
+    # a model with folded normalization takes the unnormalized images and the per image affine
+    fold_norm = getattr(model, 'fold_norm', False)
+    # image_cache_mb is shared by the data loading workers
+    ds = NeonDataset(new_norm, domain='test', src_img='neon', trained_rgb=trained_rgb, no_norm=no_norm,
+                     image_cache_mb=image_cache_mb / max(num_workers, 1))
+    if no_norm or trained_rgb:
+        model_norm = None
+    
+    # normalization percentiles computed once per scene, cached in the quantile_cache directory
+    scene_quantiles = None
+    if quantile_cache is not None and not (no_norm or trained_rgb):
+        cache = SceneQuantileCache(quantile_cache, model_norm, normnet_path)
+        scene_quantiles = torch.stack([
+            cache(ds.root_dir / l['neon'], None if new_norm else ds.root_dir / l['maxar'])
+            for _, l in tqdm(ds.df.iterrows(), total=len(ds.df), desc='scene quantiles')]).to(device)
+    # each worker goes through the crops of its own scenes, decoded once in its image cache
+    sampler = SceneBatchSampler(ds.scenes(), bs, num_workers=num_workers, shuffle=True)
+    dataloader = torch.utils.data.DataLoader(ds, batch_sampler=sampler, num_workers=num_workers)
         
     Path('../reports').joinpath(name).mkdir(parents=True, exist_ok=True)
     Path('../reports/'+name).joinpath('results_for_fig_'+dataset_key).mkdir(parents=True, exist_ok=True)
@@ -201,7 +689,12 @@ def evaluate(model,
     for batch in tqdm(dataloader):
         chm = batch['chm'].detach()
         batch = {k:v.to(device) for k, v in batch.items() if isinstance(v, torch.Tensor)}
-        pred = model(norm(batch['img']))
+        batch = normalize_batch(batch, model_norm, fold_affine=fold_norm, scene_quantiles=scene_quantiles)
+        if fold_norm:
+            affine = batch.get('affine')
+            pred = model(batch['img'], None if affine is None else (affine[:, 0], affine[:, 1]))
+        else:
+            pred = model(norm(batch['img']))
         pred = pred.cpu().detach().relu()
         
         if display == True:
@@ -263,12 +756,24 @@ def evaluate(model,
 def parse_args():
     parser = argparse.ArgumentParser(
         description='test a model')
-    parser.add_argument('--checkpoint', type=str, help='CHM pred checkpoint file', default='saved_checkpoints/compressed_SSLlarge.pth')
+    parser.add_argument('--checkpoint', type=str, help='CHM pred checkpoint file, or artifact written by export.py --artifact', default='saved_checkpoints/compressed_SSLlarge.pth')
     parser.add_argument('--name', type=str, help='run name', default='output_inference')
     parser.add_argument('--trained_rgb', type=str, help='True if model was finetuned on aerial data')
     parser.add_argument('--normnet', type=str, help='path to a normalization network', default='saved_checkpoints/aerial_normalization_quantiles_predictor.ckpt')
     parser.add_argument('--normtype', type=int, help='0: no norm; 1: old norm, 2: new norm', default=2) 
     parser.add_argument('--display', type=bool, help='saving outputs in images')
+    parser.add_argument('--image_cache_mb', type=int, help='budget of the decoded images caches, split across the data loading workers', default=256)
+    parser.add_argument('--quantile_cache', type=str, help='directory caching the normalization percentiles of each scene, shared by all its tiles')
+    parser.add_argument('--attn_backend', type=str, help='attention implementation: math, sdpa (fused kernel) or chunked (bounded memory for large windows)', default='math')
+    parser.add_argument('--attn_chunk_size', type=int, help='queries per chunk for --attn_backend chunked', default=256)
+    parser.add_argument('--inference_only', action='store_true', help='drop backbone blocks and weights not used by the decoder')
+    parser.add_argument('--token_merging', type=int, help='number of tokens merged after each backbone block (speed mode)', default=0)
+    parser.add_argument('--mmap', action='store_true', help='memory map the weights, shared by the processes of a host (torch >= 2.1)')
+    parser.add_argument('--optimize_normnet', action='store_true', help='fold the BatchNorms of the normalization network and run it channels last')
+    parser.add_argument('--normnet_int8_fc', action='store_true', help='also quantize the fully connected layers of the normalization network to int8')
+    parser.add_argument('--fold_norm', action='store_true', help='fold the image normalizations into the patch embedding')
+    parser.add_argument('--fast_topology', action='store_true', help='project the decoder feature maps before upsampling them')
+    parser.add_argument('--no_inplace', action='store_true', help='run the decoder residual units out of place')
     args = parser.parse_args()
     return args
 
@@ -286,28 +791,33 @@ def main():
     
     # 1- load network and its weight to normalize aerial images to match intensities from satellite images. 
     norm_path = args.normnet 
-    ckpt = torch.load(norm_path, map_location='cpu')
-    state_dict = ckpt['state_dict']
-    for k in list(state_dict.keys()):
-        if 'backbone.' in k:
-            new_k = k.replace('backbone.','')
-            state_dict[new_k] = state_dict.pop(k)
-    
-    model_norm = RNet(n_classes=6)
-    model_norm = model_norm.eval()
-    model_norm.load_state_dict(state_dict)
+    model_norm = load_normnet(norm_path, mmap=args.mmap, optimize=args.optimize_normnet,
+                              quantize_fc=args.normnet_int8_fc)
         
     # 2- load SSL model
-    model = SSLModule(ssl_path = args.checkpoint)
-    model.to(device)
-    model = model.eval()
+    if is_artifact(args.checkpoint):
+        device = 'cpu'
+        model, metadata = load_artifact(args.checkpoint)
+        norm_mean, norm_std = metadata['norm_mean'], metadata['norm_std']
+    else:
+        model = SSLModule(ssl_path = args.checkpoint, attn_backend=args.attn_backend, attn_chunk_size=args.attn_chunk_size,
+                          inference_only=args.inference_only, token_merging=args.token_merging, mmap=args.mmap,
+                          fold_norm=args.fold_norm, fast_topology=args.fast_topology, inplace=not args.no_inplace)
+        model.to(device)
+        model = model.eval()
+        norm_mean, norm_std = NORM_MEAN, NORM_STD
     
     # 3- image normalization for each image going through the encoder
-    norm = T.Normalize((0.420, 0.411, 0.296), (0.213, 0.156, 0.143))
+    norm = T.Normalize(norm_mean, norm_std)
     norm = norm.to(device)
+    # aerial images are normalized per batch on the device of the model,
+    # except by dynamic int8 Linear layers, which only run on CPU
+    if not args.normnet_int8_fc:
+        model_norm = model_norm.to(device)
     
     # 4- evaluation 
-    evaluate(model, norm, model_norm, name=args.name, bs=16, trained_rgb=args.trained_rgb, normtype=args.normtype, device=device, display=args.display)
+    evaluate(model, norm, model_norm, name=args.name, bs=16, trained_rgb=args.trained_rgb, normtype=args.normtype, device=device, display=args.display,
+             quantile_cache=args.quantile_cache, normnet_path=norm_path, image_cache_mb=args.image_cache_mb)
 
 if __name__ == '__main__':
     main()
@@ -145,7 +145,25 @@ class Mlp(nn.Module):
         return x
 
 
+ATTN_BACKENDS = ("math", "sdpa", "chunked")
+
+
 class Attention(nn.Module):
+    """Multi-head self attention.
+
+    Args:
+        attn_backend (str): "math" builds the full attention matrix with
+            explicit matmul/softmax ops, "sdpa" calls the fused
+            ``F.scaled_dot_product_attention`` kernel, which never keeps the
+            (N, N) attention matrix alive on the memory-efficient paths,
+            "chunked" runs the math path on blocks of ``attn_chunk_size``
+            queries so that at most a (chunk, N) attention matrix per head is
+            alive, which bounds memory for large windows (N > 4096 tokens).
+            Default: "math".
+        attn_chunk_size (int): number of queries per chunk for the "chunked"
+            backend. Default: 256.
+    """
+
     def __init__(
         self,
         dim: int,
@@ -153,11 +171,16 @@ class Attention(nn.Module):
         qkv_bias: bool = False,
         attn_drop: float = 0.0,
         proj_drop: float = 0.0,
+        attn_backend: str = "math",
+        attn_chunk_size: int = 256,
     ) -> None:
         super().__init__()
+        assert attn_backend in ATTN_BACKENDS, f"attn_backend must be one of {ATTN_BACKENDS}, got {attn_backend}"
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = head_dim**-0.5
+        self.attn_backend = attn_backend
+        self.attn_chunk_size = attn_chunk_size
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
@@ -168,13 +191,29 @@ class Attention(nn.Module):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
 
-        q, k, v = qkv[0] * self.scale, qkv[1], qkv[2]
-        attn = q @ k.transpose(-2, -1)
+        if self.attn_backend == "sdpa":
+            # q, k, v stay views on qkv; the default scale of the kernel is head_dim**-0.5
+            q, k, v = qkv.unbind(0)
+            x = F.scaled_dot_product_attention(q, k, v, dropout_p=self.attn_drop.p if self.training else 0.0)
+        elif self.attn_backend == "chunked":
+            q, k, v = qkv.unbind(0)
+            k_t = k.transpose(-2, -1)
+            x = torch.empty_like(q)
+            for start in range(0, N, self.attn_chunk_size):
+                end = start + self.attn_chunk_size
+                attn = (q[:, :, start:end] * self.scale) @ k_t
+                attn = attn.softmax(dim=-1)
+                attn = self.attn_drop(attn)
+                x[:, :, start:end] = attn @ v
+        else:
+            q, k, v = qkv[0] * self.scale, qkv[1], qkv[2]
+            attn = q @ k.transpose(-2, -1)
 
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -211,6 +250,8 @@ class Block(nn.Module):
         norm_layer: Callable[..., nn.Module] = nn.LayerNorm,
         attn_class: Callable[..., nn.Module] = Attention,
         ffn_layer: Callable[..., nn.Module] = Mlp,
+        attn_backend: str = "math",
+        attn_chunk_size: int = 256,
     ) -> None:
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -220,6 +261,8 @@ class Block(nn.Module):
             qkv_bias=qkv_bias,
             attn_drop=attn_drop,
             proj_drop=drop,
+            attn_backend=attn_backend,
+            attn_chunk_size=attn_chunk_size,
         )
         self.ls1 = LayerScale(dim, init_values=init_values) if init_values else nn.Identity()
         self.drop_path1 = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
@@ -265,6 +308,65 @@ class Block(nn.Module):
         return x
 
 
+def get_2d_sincos_pos_embed_cached_device(embed_dim, grid_size, step_coef=1.0, omega_coef=10000, device=None, cls_token=False):
+    """Fixed 2D sin-cos position embedding of shape (1, [1 +] grid_size**2, embed_dim).
+    Callers are expected to cache the result, see
+    ``DinoVisionTransformer.interpolate_pos_encoding``.
+    """
+    assert embed_dim % 4 == 0, f"embed_dim must be a multiple of 4, got {embed_dim}"
+    grid = torch.arange(grid_size, dtype=torch.float32, device=device) / step_coef
+    grid_h, grid_w = torch.meshgrid(grid, grid, indexing="ij")
+    omega = torch.arange(embed_dim // 4, dtype=torch.float32, device=device) / (embed_dim / 4.0)
+    omega = 1.0 / omega_coef**omega
+    out_h = grid_h.reshape(-1, 1) * omega
+    out_w = grid_w.reshape(-1, 1) * omega
+    pos_embed = torch.cat((out_h.sin(), out_h.cos(), out_w.sin(), out_w.cos()), dim=1)
+    if cls_token:
+        pos_embed = torch.cat((torch.zeros(1, embed_dim, device=device), pos_embed), dim=0)
+    return pos_embed.unsqueeze(0)
+
+
+def bipartite_soft_matching(x: Tensor, r: int, size: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+    """Token merging (ToMe, https://arxiv.org/abs/2210.09461) of the r most
+    similar token pairs. Tokens are split alternately into sets A and B, each A
+    token is matched to its most similar B token (cosine similarity) and the r
+    best matched A tokens are averaged into their match, weighted by `size`, the
+    number of patches each token stands for. The class token is never merged
+    and stays first.
+
+    Returns the merged tokens, their sizes and, for every input token, the index
+    of the token it went into.
+    """
+    B, N, C = x.shape
+    metric = x / x.norm(dim=-1, keepdim=True)
+    a, b = metric[:, ::2], metric[:, 1::2]
+    n_a, n_b = a.shape[1], b.shape[1]
+    r = min(r, n_a - 1)
+
+    scores = a @ b.transpose(-1, -2)
+    scores[:, 0] = -math.inf
+    node_max, node_idx = scores.max(dim=-1)
+    edge_idx = node_max.argsort(dim=-1, descending=True)
+    src_idx = edge_idx[:, :r]
+    # sorted, so that the class token stays first
+    unm_idx = edge_idx[:, r:].sort(dim=-1).values
+    dst_idx = node_idx.gather(1, src_idx)
+
+    n_unm = n_a - r
+    arange = torch.arange(max(n_unm, n_b), device=x.device)
+    pos_a = torch.empty(B, n_a, dtype=torch.long, device=x.device)
+    pos_a.scatter_(1, unm_idx, arange[:n_unm].expand(B, -1))
+    pos_a.scatter_(1, src_idx, n_unm + dst_idx)
+    new_pos = torch.empty(B, N, dtype=torch.long, device=x.device)
+    new_pos[:, ::2] = pos_a
+    new_pos[:, 1::2] = n_unm + arange[:n_b]
+
+    index = new_pos.unsqueeze(-1)
+    new_size = size.new_zeros(B, n_unm + n_b, 1).scatter_add_(1, index, size)
+    x = x.new_zeros(B, n_unm + n_b, C).scatter_add_(1, index.expand(-1, -1, C), x * size) / new_size
+    return x, new_size, new_pos
+
+
 def make_2tuple(x):
     if isinstance(x, tuple):
         assert len(tuple) == 2
@@ -315,14 +417,52 @@ class PatchEmbed(nn.Module):
         self.norm = norm_layer(embed_dim) if norm_layer else nn.Identity()
         
 
-    def forward(self, x: Tensor) -> Tensor:
+    def fold_input_affine(self, mean, std) -> None:
+        """Fold the input normalization (x - mean) / std into the projection
+        weights and bias, so that forward takes unnormalized images. Exact for
+        images whose size is a multiple of the patch size (padded pixels are
+        zero before, not after, the normalization)."""
+        weight, bias = self.proj.weight, self.proj.bias
+        mean = torch.as_tensor(mean, dtype=weight.dtype, device=weight.device)
+        std = torch.as_tensor(std, dtype=weight.dtype, device=weight.device)
+        with torch.no_grad():
+            new_weight = weight / std[None, :, None, None]
+            new_bias = bias - (new_weight * mean[None, :, None, None]).sum(dim=(1, 2, 3))
+        # new parameters rather than in place updates, which would unshare memory mapped weights
+        self.proj.weight = nn.Parameter(new_weight, requires_grad=weight.requires_grad)
+        self.proj.bias = nn.Parameter(new_bias, requires_grad=bias.requires_grad)
+
+    def _project_affine(self, x: Tensor, scale: Tensor, shift: Tensor) -> Tensor:
+        # proj(x * scale + shift) with weight * scale and bias + shift @ sum(weight)
+        # for each image: the B images are the groups of a single convolution
+        B, C, H, W = x.shape
+        weight = self.proj.weight
+        bias = self.proj.bias
+        weights = (weight[None] * scale[:, None, :, None, None]).flatten(0, 1)
+        biases = shift @ weight.sum(dim=(2, 3)).t()
+        if bias is not None:
+            biases = biases + bias
+        x = F.conv2d(x.reshape(1, B * C, H, W), weights, biases.flatten(), stride=self.patch_size, groups=B)
+        return x.view(B, -1, *x.shape[-2:])
+
+    def forward(self, x: Tensor, affine: Optional[Tuple[Tensor, Tensor]] = None) -> Tensor:
+        """
+        Args:
+            affine: optional per image, per channel (scale, shift) of shape (B, C)
+                applied to x before the projection. Both are folded into per
+                image projection weights and biases, applied by one grouped
+                convolution, so x is never rescaled.
+        """
         _, _, H, W = x.shape
         patch_H, patch_W = self.patch_size
 
         assert H % patch_H == 0, f"Input image height {H} is not a multiple of patch height {patch_H}"
         assert W % patch_W == 0, f"Input image width {W} is not a multiple of patch width: {patch_W}"
 
-        x = self.proj(x)
+        if affine is None:
+            x = self.proj(x)
+        else:
+            x = self._project_affine(x, *affine)
         x = x.flatten(2).transpose(1, 2)
         x = self.norm(x)
         return x
@@ -370,6 +510,9 @@ class DinoVisionTransformer(nn.Module):
         sin_cos_embeddings=False,
         local_crops_size=96,
         multiple_pos_embeddings=False,
+        pos_embed_cache_size=8,
+        attn_backend="math",
+        attn_chunk_size=256,
     ):
         """
         Args:
@@ -392,6 +535,10 @@ class DinoVisionTransformer(nn.Module):
             embed_layer (nn.Module): patch embedding layer
             norm_layer: (nn.Module): normalization layer
             act_layer: (nn.Module): MLP activation layer
+            pos_embed_cache_size (int): number of resized position embeddings kept per
+                (w, h, device, dtype), 0 disables the cache
+            attn_backend (str): attention implementation of every block, see ``Attention``
+            attn_chunk_size (int): queries per chunk of the "chunked" attention backend
         """
         super().__init__()
         assert global_pool in ("", "avg", "token")
@@ -405,6 +552,9 @@ class DinoVisionTransformer(nn.Module):
         self.grad_checkpointing = False
         self.sin_cos_embeddings = sin_cos_embeddings
         self.multiple_pos_embeddings = multiple_pos_embeddings
+        # resized position embeddings, least recently used first
+        self.pos_embed_cache_size = pos_embed_cache_size
+        self._pos_embed_cache = OrderedDict()
 
         self.patch_embed = embed_layer(
             img_size=img_size, patch_size=patch_size, in_chans=in_chans, embed_dim=embed_dim
@@ -460,6 +610,8 @@ class DinoVisionTransformer(nn.Module):
                     act_layer=act_layer,
                     ffn_layer=ffn_layer,
                     init_values=init_values,
+                    attn_backend=attn_backend,
+                    attn_chunk_size=attn_chunk_size,
                 )
                 for i in range(depth)
             ]
@@ -531,6 +683,15 @@ class DinoVisionTransformer(nn.Module):
     def set_grad_checkpointing(self, enable=True):
         self.grad_checkpointing = enable
 
+    def set_attn_backend(self, attn_backend, attn_chunk_size=None):
+        """Switch the attention implementation of all blocks, e.g. after the weights are loaded."""
+        assert attn_backend in ATTN_BACKENDS, f"attn_backend must be one of {ATTN_BACKENDS}, got {attn_backend}"
+        for m in self.modules():
+            if isinstance(m, Attention):
+                m.attn_backend = attn_backend
+                if attn_chunk_size is not None:
+                    m.attn_chunk_size = attn_chunk_size
+
     @torch.jit.ignore
     def get_classifier(self):
         return self.head
@@ -552,7 +713,40 @@ class DinoVisionTransformer(nn.Module):
         x = self.pre_logits(x)
         return x if pre_logits else self.head(x)
 
+    def _load_from_state_dict(self, *args, **kwargs):
+        # resized embeddings are derived from the weights being replaced
+        self._pos_embed_cache.clear()
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def _apply(self, *args, **kwargs):
+        # drop embeddings resized for the former device / dtype
+        self._pos_embed_cache.clear()
+        return super()._apply(*args, **kwargs)
+
     def interpolate_pos_encoding(self, x, w, h):
+        if self.multiple_pos_embeddings:
+            return self._interpolate_pos_encoding(x, w, h)
+        if not self.sin_cos_embeddings:
+            npatch = x.shape[1] - 1
+            N = self.pos_embed.shape[1] - 1
+            if npatch == N and w == h:
+                return self.pos_embed
+        # a cached tensor would be cut from the graph of a trainable pos_embed
+        if self.pos_embed_cache_size <= 0 or (torch.is_grad_enabled() and self.pos_embed.requires_grad):
+            return self._interpolate_pos_encoding(x, w, h)
+
+        key = (w, h, x.device, x.dtype)
+        pos_embed = self._pos_embed_cache.get(key)
+        if pos_embed is None:
+            pos_embed = self._interpolate_pos_encoding(x, w, h)
+            self._pos_embed_cache[key] = pos_embed
+            if len(self._pos_embed_cache) > self.pos_embed_cache_size:
+                self._pos_embed_cache.popitem(last=False)
+        else:
+            self._pos_embed_cache.move_to_end(key)
+        return pos_embed
+
+    def _interpolate_pos_encoding(self, x, w, h):
         if self.sin_cos_embeddings:
             
             w0 = w // self.patch_embed.patch_size[0]
@@ -630,9 +824,9 @@ class DinoVisionTransformer(nn.Module):
         
         return x, masks, upperbound
 
-    def prepare_tokens(self, x, mask_ratio_tuple=(0.0, 0.0), mask_sample_probability=0.0, ibot_balanced_masking=False):
+    def prepare_tokens(self, x, mask_ratio_tuple=(0.0, 0.0), mask_sample_probability=0.0, ibot_balanced_masking=False, affine=None):
         B, nc, w, h = x.shape
-        x = self.patch_embed(x)
+        x = self.patch_embed(x, affine=affine)
         masks = None
         n_masked_patches_upperbound = None
         cls_token = self.cls_token
@@ -648,7 +842,7 @@ class DinoVisionTransformer(nn.Module):
                 x, masks = self.mask_patches_with_probability_p(
                     x, mask_ratio_tuple=mask_ratio_tuple, p=mask_sample_probability
                 )
-        else:
+        elif self.mask_token is not None:
             cls_token = cls_token + 0 * self.mask_token  # hack to use the mask_token param to not crash ddp...
 
         x = torch.cat((cls_token.expand(x.shape[0], -1, -1), x), dim=1)
@@ -763,6 +957,16 @@ class AdaptivePadding(nn.Module):
 
 class SSLVisionTransformer(DinoVisionTransformer):
     """Vision Transformer.
+
+    Args:
+        inference_only (bool): keep only the blocks up to ``max(out_indices)``
+            and drop the state that dense prediction does not use (``norm``
+            unless ``final_norm``, ``head``, ``mask_token`` and
+            ``mask_generator``). The dropped weights are skipped when loading
+            a full checkpoint. Default: False.
+        token_merging (int | list[int]): number of tokens merged after each
+            block (or after block i for a list), see ``set_token_merging``.
+            Default: 0.
     """
 
     def __init__(self,
@@ -782,6 +986,8 @@ class SSLVisionTransformer(DinoVisionTransformer):
                 with_cls_token=True,
                 output_cls_token=True,
                 frozen_stages=100,
+                inference_only=False,
+                token_merging=0,
                  *args, **kwargs):
         super(SSLVisionTransformer, self).__init__(*args, **kwargs) 
        
@@ -819,6 +1025,13 @@ class SSLVisionTransformer(DinoVisionTransformer):
         self.final_norm = final_norm
         self.patch_size = self.patch_embed.patch_size
         self.adapad = AdaptivePadding(kernel_size=self.patch_size, stride=self.patch_size, padding='same')
+        self.inference_only = False
+        self._register_load_state_dict_pre_hook(self._skip_truncated_weights)
+        # depth of the full model, which token_merging lists may be given for
+        self.depth = len(self.blocks)
+        if inference_only:
+            self.truncate_for_inference()
+        self.set_token_merging(token_merging)
         if pretrained:
             self.init_weights(pretrained)
         
@@ -853,6 +1066,46 @@ class SSLVisionTransformer(DinoVisionTransformer):
         pos_embed = torch.cat((cls_token_weight, pos_embed_weight), dim=1)
         return pos_embed
     
+    def truncate_for_inference(self):
+        """Drop the blocks after the last out_indices tap, whose outputs are
+        never consumed, and the pretraining / classification state."""
+        self.blocks = self.blocks[:max(self.out_indices) + 1]
+        if not self.final_norm:
+            self.norm = nn.Identity()
+        self.head = nn.Identity()
+        self.mask_token = None
+        self.mask_generator = None
+        self.inference_only = True
+
+    def set_token_merging(self, r):
+        """Inference speed mode merging the r most similar tokens after each
+        block (r[i] after block i if r is a list), with ToMe bipartite matching.
+        Merged tokens are copied back to every patch they stand for at each
+        out_indices tap, so the decoder always gets the full patch grid.
+        Homogeneous regions (fields, water, uniform forest) merge first.
+        A list may also be given for the full depth of a backbone truncated by
+        truncate_for_inference, the entries of the dropped blocks being ignored."""
+        if isinstance(r, int):
+            r = [r] * len(self.blocks)
+        assert len(r) in (len(self.blocks), self.depth), \
+            f'expected {len(self.blocks)} or {self.depth} merge ratios, got {len(r)}'
+        self.token_merging = list(r)[:len(self.blocks)]
+
+    def _skip_truncated_weights(self, state_dict, prefix, *args):
+        if not self.inference_only:
+            return
+        for k in list(state_dict.keys()):
+            if not k.startswith(prefix):
+                continue
+            name = k[len(prefix):]
+            if name.startswith('blocks.'):
+                skip = int(name.split('.')[1]) >= len(self.blocks)
+            else:
+                skip = (name == 'mask_token' or name.startswith('head.')
+                        or (name.startswith('norm.') and not self.final_norm))
+            if skip:
+                del state_dict[k]
+
     def init_weights(self, pretrained):
         print("init_weights", pretrained)
         if (isinstance(self.init_cfg, dict)
@@ -893,8 +1146,12 @@ class SSLVisionTransformer(DinoVisionTransformer):
             super(SSLVisionTransformer, self).init_weights()
             
 
-    def forward(self, x):
-        
+    def forward(self, x, affine=None):
+        """
+        Args:
+            affine: optional per image, per channel (scale, shift) of shape
+                (B, 3) applied to x, see ``PatchEmbed.forward``.
+        """
         with torch.set_grad_enabled(not self.detach):
             _, _, old_w, old_h = x.shape
             xx = self.adapad(x)
@@ -902,21 +1159,27 @@ class SSLVisionTransformer(DinoVisionTransformer):
             x = F.pad(x, (0, xx.shape[-1] - x.shape[-1], 0, xx.shape[-2] - x.shape[-2]))
             B, nc, w, h = x.shape
 
-            x, _, _ = self.prepare_tokens(x)
+            x, _, _ = self.prepare_tokens(x, affine=affine)
+            # token_map[b, n]: index of the (merged) token holding input token n
+            token_map, size = None, None
             # we return the output tokens from the `n` last blocks
             outs = []
             for i, blk in enumerate(self.blocks):
                 x = blk(x)
                 if i in self.out_indices:
+                    if token_map is None:
+                        x_full = x
+                    else:
+                        x_full = x.gather(1, token_map.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
                     if self.with_cls_token:
-                        out = x[:, 1:]
+                        out = x_full[:, 1:]
                     else:
-                        out = x
+                        out = x_full
                     B, _, C = out.shape
                     out = out.reshape(B, w // self.patch_size[0], h // self.patch_size[1],
                                     C).permute(0, 3, 1, 2).contiguous()
                     if self.output_cls_token:
-                        out = [out, x[:, 0]]
+                        out = [out, x_full[:, 0]]
                     else:
                         out = [out]
                     if self.final_norm:
@@ -924,6 +1187,12 @@ class SSLVisionTransformer(DinoVisionTransformer):
                     if self.detach:
                         out = [o.detach() for o in out]
                     outs.append(out)
+                if self.token_merging[i] > 0 and i < max(self.out_indices):
+                    if token_map is None:
+                        token_map = torch.arange(x.shape[1], device=x.device).expand(x.shape[0], -1)
+                        size = x.new_ones(x.shape[0], x.shape[1], 1)
+                    x, size, new_pos = bipartite_soft_matching(x, self.token_merging[i], size)
+                    token_map = new_pos.gather(1, token_map)
             return tuple(outs)
 
     def train(self, mode=True):
@@ -940,7 +1209,8 @@ class SSLVisionTransformer(DinoVisionTransformer):
                     param.requires_grad = False
             self.cls_token.requires_grad = False
             self.pos_embed.requires_grad = False
-            self.mask_token.requires_grad = False
+            if self.mask_token is not None:
+                self.mask_token.requires_grad = False
 
         if self.frozen_stages >= len(self.blocks) - 1:
             self.norm.eval()
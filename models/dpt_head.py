@@ -7,6 +7,8 @@
 import torch
 from torch import nn
 import torchvision
+from torch.ao import quantization
+import torch.ao.nn.quantized.dynamic as nnqd
 
 from models.backbone import resize
 
@@ -312,8 +314,7 @@ class ReassembleBlocks(nn.Module):
             feature_shape = x.shape
             if self.readout_type == 'project':
                 x = x.flatten(2).permute((0, 2, 1))
-                readout = cls_token.unsqueeze(1).expand_as(x)
-                x = self.readout_projects[i](torch.cat((x, readout), -1))
+                x = self.project_readout(self.readout_projects[i], x, cls_token)
                 x = x.permute(0, 2, 1).reshape(feature_shape)
             elif self.readout_type == 'add':
                 x = x.flatten(2) + cls_token.unsqueeze(-1)
@@ -325,6 +326,82 @@ class ReassembleBlocks(nn.Module):
             out.append(x)
         return out
 
+    @staticmethod
+    def project_readout(readout_project, x, cls_token):
+        """Linear projection of the (B, N, C) patch tokens concatenated with
+        the cls token, followed by GELU. The projection is split in a patch
+        half and a cls half: the cls half is computed once per image and added
+        to the patch half, instead of concatenating the expanded cls token to
+        every patch. Dynamic int8 projections are split once by
+        `split_readout_projects`, other quantized ones take the concatenation."""
+        if isinstance(readout_project, SplitReadoutProject):
+            return readout_project(x, cls_token)
+        linear, activate = readout_project
+        if type(linear) is not nn.Linear:
+            readout = cls_token.unsqueeze(1).expand_as(x)
+            return readout_project(torch.cat((x, readout), -1))
+        C = x.shape[-1]
+        readout = nn.functional.linear(cls_token, linear.weight[:, C:], linear.bias)
+        x = nn.functional.linear(x, linear.weight[:, :C])
+        x += readout.unsqueeze(1)
+        return activate(x)
+
+    def split_readout_projects(self):
+        """Split the dynamic int8 readout projections (compressed checkpoints)
+        into a patch and a cls projection, see SplitReadoutProject. Call it once
+        the weights are loaded."""
+        if self.readout_type != 'project':
+            return
+        for i, readout_project in enumerate(self.readout_projects):
+            if isinstance(readout_project, nn.Sequential) and isinstance(readout_project[0], nnqd.Linear):
+                self.readout_projects[i] = SplitReadoutProject.from_dynamic(*readout_project)
+
+
+def _quantize_like(weight, like):
+    # values already on the quantization grid of like: requantized exactly
+    if like.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+        return torch.quantize_per_channel(weight, like.q_per_channel_scales(), like.q_per_channel_zero_points(),
+                                          like.q_per_channel_axis(), like.dtype)
+    return torch.quantize_per_tensor(weight, like.q_scale(), like.q_zero_point(), like.dtype)
+
+
+class SplitReadoutProject(nn.Module):
+    """Readout projection of ReassembleBlocks as two Linear layers on the
+    patch and cls halves of the concatenated input, followed by the
+    activation: the cls projection runs once per image instead of once per
+    patch.
+    Args:
+        patch (nn.Module): projection of the patch tokens, without bias.
+        cls (nn.Module): projection of the cls token, with the bias.
+        activate (nn.Module): activation.
+    """
+
+    def __init__(self, patch, cls, activate):
+        super(SplitReadoutProject, self).__init__()
+        self.patch = patch
+        self.cls = cls
+        self.activate = activate
+
+    @classmethod
+    def from_dynamic(cls, linear, activate):
+        """Split a dynamic int8 Linear over the (patch, cls) concatenation. The
+        int8 weights are split by column and repacked, unchanged."""
+        weight, bias = linear.weight(), linear.bias()
+        C = linear.in_features // 2
+        dequantized = weight.dequantize()
+        halves = []
+        for columns, half_bias in ((slice(None, C), None), (slice(C, None), bias)):
+            half = nnqd.Linear(C, linear.out_features, bias_=half_bias is not None, dtype=weight.dtype)
+            half.set_weight_bias(_quantize_like(dequantized[:, columns].contiguous(), weight), half_bias)
+            halves.append(half)
+        return cls(*halves, activate)
+
+    def forward(self, x, cls_token):
+        readout = self.cls(cls_token)
+        x = self.patch(x)
+        x += readout.unsqueeze(1)
+        return self.activate(x)
+
 
 class PreActResidualConvUnit(nn.Module):
     """ResidualConvUnit, pre-activate residual unit.
@@ -335,6 +412,10 @@ class PreActResidualConvUnit(nn.Module):
         stride (int): stride of the first block. Default: 1
         dilation (int): dilation rate for convs layers. Default: 1.
         init_cfg (dict, optional): Initialization config dict. Default: None.
+    Attributes:
+        inplace (bool): without autograd, apply the second activation and the
+            residual addition in place instead of cloning the inputs. Default:
+            False.
     """
 
     def __init__(self,
@@ -365,7 +446,16 @@ class PreActResidualConvUnit(nn.Module):
             act_cfg=act_cfg,
             bias=False,
             order=('act', 'conv', 'norm'))
+        self.inplace = False
+
     def forward(self, inputs):
+        # quantized convolutions are wrapped, their activation cannot be taken out
+        if self.inplace and not torch.is_grad_enabled() and isinstance(self.conv2, ConvModule):
+            # the activation of conv1 is out of place: inputs is left unchanged for the residual
+            x = self.conv1(inputs)
+            x = self.conv2(torch.relu_(x), activate=False)
+            x += inputs
+            return x
         inputs_ = inputs.clone()
         x = self.conv1(inputs)
         x = self.conv2(x)
@@ -382,6 +472,10 @@ class FeatureFusionBlock(nn.Module):
             Default: False.
         align_corners (bool): align_corner setting for bilinear upsample.
             Default: True.
+        fast_topology (bool): apply the 1x1 projection before the bilinear
+            upsample instead of after it. Both are linear and the bilinear
+            weights sum to 1, so the output is the same up to floating point
+            rounding, with 4x fewer projection MACs. Default: False.
         init_cfg (dict, optional): Initialization config dict. Default: None.
     """
 
@@ -391,11 +485,15 @@ class FeatureFusionBlock(nn.Module):
                  norm_cfg,
                  expand=False,
                  align_corners=True,
+                 fast_topology=False,
                  init_cfg=None):
         super(FeatureFusionBlock, self).__init__()#init_cfg)
         self.in_channels = in_channels
         self.expand = expand
         self.align_corners = align_corners
+        self.fast_topology = fast_topology
+        # see PreActResidualConvUnit
+        self.inplace = False
         self.out_channels = in_channels
         if self.expand:
             self.out_channels = in_channels // 2
@@ -422,10 +520,20 @@ class FeatureFusionBlock(nn.Module):
                     align_corners=False)
             else:
                 res = inputs[1]
-            x = x + self.res_conv_unit1(res)
+            if self.inplace and not torch.is_grad_enabled():
+                # the residual unit returns a new tensor
+                res = self.res_conv_unit1(res)
+                res += x
+                x = res
+            else:
+                x = x + self.res_conv_unit1(res)
         x = self.res_conv_unit2(x) 
-        x = resize( x, scale_factor=2, mode='bilinear', align_corners=self.align_corners)
-        x = self.project(x) 
+        if self.fast_topology:
+            x = self.project(x)
+            x = resize( x, scale_factor=2, mode='bilinear', align_corners=self.align_corners)
+        else:
+            x = resize( x, scale_factor=2, mode='bilinear', align_corners=self.align_corners)
+            x = self.project(x) 
         return x
 
 class DPTHead(nn.Module):
@@ -440,6 +548,15 @@ class DPTHead(nn.Module):
         patch_size (int): The patch size. Default: 16.
         expand_channels (bool): Whether expand the channels in post process
             block. Default: False.
+        bin_chunk_size (int): number of bins summed at a time when decoding
+            the classification logits, see `decode_bins`. Default: 32.
+        uncertainty (bool): with `classify`, also output the standard
+            deviation and the `quantiles` of the per pixel distribution over
+            the bins, see `decode_bins`. Default: False.
+        quantiles (Sequence[float]): quantiles output with `uncertainty`.
+            Default: (0.1, 0.9).
+        fast_topology (bool): project the feature maps of the fusion blocks
+            before upsampling them, see `FeatureFusionBlock`. Default: False.
     """
 
     def __init__(self,
@@ -453,6 +570,10 @@ class DPTHead(nn.Module):
                  min_depth = 0.001,
                  classify=False,
                  n_bins=256,
+                 bin_chunk_size=32,
+                 uncertainty=False,
+                 quantiles=(0.1, 0.9),
+                 fast_topology=False,
                  **kwargs):
         super(DPTHead, self).__init__(**kwargs)
         torch.manual_seed(1)
@@ -462,6 +583,11 @@ class DPTHead(nn.Module):
         self.max_depth = 10
         self.n_bins = n_bins
         self.classify = classify
+        self.bin_chunk_size = bin_chunk_size
+        self.uncertainty = uncertainty
+        self.quantiles = tuple(quantiles)
+        # uniform bins, built once instead of at every forward
+        self.register_buffer('bins', torch.linspace(self.min_depth, self.max_depth, self.n_bins), persistent=False)
         self.in_channels = in_channels
         self.expand_channels = expand_channels
         self.reassemble_blocks = ReassembleBlocks(in_channels=embed_dims, # Camille 23-06-26 
@@ -485,7 +611,7 @@ class DPTHead(nn.Module):
         self.act_cfg = {'type': 'ReLU'}
         for _ in range(len(self.convs)):
             self.fusion_blocks.append(
-                FeatureFusionBlock(self.channels, self.act_cfg, self.norm_cfg))
+                FeatureFusionBlock(self.channels, self.act_cfg, self.norm_cfg, fast_topology=fast_topology))
         self.fusion_blocks[0].res_conv_unit1 = None
         torch.manual_seed(1)
         self.project = ConvModule(
@@ -500,6 +626,8 @@ class DPTHead(nn.Module):
         assert self.num_fusion_blocks == self.num_reassemble_blocks
         assert self.num_reassemble_blocks == self.num_post_process_channels
         #self.conv_depth = HeadDepth(self.channels)
+        # HeadDepth already reduces the channels with its first 3x3 conv before upsampling,
+        # and its second 3x3 conv does not commute with the upsample: no fast topology there
         self.conv_depth = HeadDepth(self.channels, self.classify, self.n_bins)
         self.relu = nn.ReLU()
         self.sigmoid = nn.Sigmoid()
@@ -520,17 +648,126 @@ class DPTHead(nn.Module):
         out = self.project(out) 
         if self.classify:
             logit = self.conv_depth(out)
-        
-            #if self.bins_strategy == 'UD':
-            bins = torch.linspace(self.min_depth, self.max_depth, self.n_bins, device=inputs[0][0].device)
-            #linear strategy
-            logit = torch.relu(logit)
-            eps = 0.1
-            logit = logit + eps
-            logit = logit / logit.sum(dim=1, keepdim=True)
-            out = torch.einsum('ikmn,k->imn', [logit, bins]).unsqueeze(dim=1) #+ self.min_depth
+            out = self.decode_bins(logit)
         else:
             out = self.relu(self.conv_depth(out)) + self.min_depth
             
         return out
-    
+
+    def set_fast_topology(self, fast_topology):
+        for block in self.fusion_blocks:
+            block.fast_topology = fast_topology
+
+    def set_inplace(self, inplace):
+        """Inference mode: residual additions and the activations applied to
+        a new tensor run in place, and the residual units do not clone their
+        inputs. Without effect under autograd for the residuals."""
+        for module in self.modules():
+            if isinstance(module, (PreActResidualConvUnit, FeatureFusionBlock)):
+                module.inplace = inplace
+            elif isinstance(module, ConvModule) and module.order[0] == 'conv' and module.with_activation \
+                    and isinstance(module.activate, nn.ReLU):
+                module.activate.inplace = inplace
+            elif isinstance(module, HeadDepth):
+                module.head[3].inplace = inplace
+
+    def decode_bins(self, logit, eps=0.1):
+        """Expected height of each pixel under the distribution over the bins
+        given by relu(logit) + eps, normalized over the bins.
+        Without autograd the (B, n_bins, H, W) logits are updated in place and
+        the normalization is applied to the (B, H, W) expectation rather than
+        to the logits, so no other logits sized tensor is allocated: the
+        weighted sum goes through the bins `bin_chunk_size` at a time.
+        With `uncertainty`, the same pass also accumulates the second moment
+        and the cumulative distribution at each quantile. A quantile is
+        interpolated linearly between the centers of the bins where the
+        cumulative distribution crosses it.
+        Returns:
+            Tensor: (B, 1, H, W) expected height, or with `uncertainty`
+                (B, 2 + len(quantiles), H, W) expected height, standard
+                deviation and quantiles.
+        """
+        if torch.is_grad_enabled() and logit.requires_grad:
+            logit = torch.relu(logit) + eps
+        else:
+            logit = torch.relu_(logit).add_(eps)
+        bins = self.bins.to(logit.dtype)
+        total = logit.sum(dim=1)
+        out = torch.zeros_like(total)
+        if self.uncertainty:
+            second = torch.zeros_like(total)
+            # unnormalized cumulative distribution at the end of the previous chunk
+            cum = torch.zeros_like(total)
+            # per quantile: number of bins and mass of the distribution before the quantile
+            targets = [q * total for q in self.quantiles]
+            counts = [torch.zeros_like(total, dtype=torch.long) for _ in self.quantiles]
+            below = [torch.zeros_like(total) for _ in self.quantiles]
+        for k in range(0, self.n_bins, self.bin_chunk_size):
+            chunk = logit[:, k:k + self.bin_chunk_size]
+            chunk_bins = bins[k:k + self.bin_chunk_size, None, None]
+            weighted = chunk * chunk_bins
+            out += weighted.sum(dim=1)
+            if self.uncertainty:
+                second += (weighted * chunk_bins).sum(dim=1)
+                cdf = chunk.cumsum(dim=1) + cum[:, None]
+                for target, count, mass in zip(targets, counts, below):
+                    before = cdf < target[:, None]
+                    count += before.sum(dim=1)
+                    # the cumulative distribution is increasing: its last value before the quantile
+                    torch.maximum(mass, (cdf * before).amax(dim=1), out=mass)
+                cum = cdf[:, -1]
+        out /= total
+        if not self.uncertainty:
+            return out.unsqueeze(dim=1)
+
+        std = (second / total - out ** 2).clamp_(min=0).sqrt_()
+        outputs = [out, std]
+        for target, count, mass in zip(targets, counts, below):
+            # bin where the cumulative distribution crosses the quantile
+            index = count.clamp_(max=self.n_bins - 1)
+            crossing = logit.gather(1, index[:, None])[:, 0]
+            frac = ((target - mass) / crossing).clamp_(0, 1)
+            low, high = bins[(index - 1).clamp(min=0)], bins[index]
+            outputs.append(low + frac * (high - low))
+        return torch.stack(outputs, dim=1)
+
+
+def _wrap_convs(module, qconfig, qconfig_transposed):
+    for name, child in module.named_children():
+        if isinstance(child, (ConvModule, nn.Conv2d, nn.ConvTranspose2d)):
+            if isinstance(child, ConvModule) and child.with_activation and child.order == ('conv', 'norm', 'act'):
+                quantization.fuse_modules(child, [['conv', 'activate']], inplace=True)
+            wrapper = quantization.QuantWrapper(child)
+            wrapper.qconfig = qconfig_transposed if isinstance(child, nn.ConvTranspose2d) else qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_convs(child, qconfig, qconfig_transposed)
+
+
+def prepare_static_quantization(head, backend='fbgemm'):
+    """Prepare the convolutions of a DPTHead for static int8 post training
+    quantization. Every ConvModule, Conv2d and ConvTranspose2d is wrapped
+    between a quantize and a dequantize stub, conv + ReLU pairs are fused, and
+    observers are inserted. The residual additions, resizes and the bin
+    decoding stay in float. Run the model on calibration tiles, then call
+    `convert_static_quantization`.
+    Args:
+        head (DPTHead): decoder to quantize in place.
+        backend (str): quantized engine the model will run with, 'fbgemm'
+            (x86) or 'qnnpack' (ARM). Default: 'fbgemm'.
+    """
+    qconfig = quantization.get_default_qconfig(backend)
+    # quantized transposed convolutions only support per tensor weights
+    qconfig_transposed = quantization.QConfig(activation=qconfig.activation,
+                                              weight=quantization.default_weight_observer)
+    _wrap_convs(head, qconfig, qconfig_transposed)
+    quantization.prepare(head, inplace=True)
+    return head
+
+
+def convert_static_quantization(head):
+    """Replace the observed convolutions of a head prepared with
+    `prepare_static_quantization` by int8 ones."""
+    quantization.convert(head, inplace=True)
+    return head
+
@@ -41,6 +41,8 @@ class RNet(nn.Module):
             )
             return layers
 
+        # size of the input images, fixed by fc1
+        self.n_pix = n_pix
         self.pool = nn.MaxPool2d(2, 2)
         self.input_layer = conv_block(n_channels, filters[0], kernel_size)
         self.conv_block1 = conv_block(filters[0], filters[1], kernel_size)
@@ -53,8 +55,35 @@ class RNet(nn.Module):
         self.fc2 = fc_block(in_features=64 + n_meta, out_features=64)
         self.fc3 = fc_block(in_features=64, out_features=32)
         self.fc4 = nn.Linear(in_features=32, out_features=n_classes)
+        self.channels_last = False
+        # inference variant, see optimize_for_inference: outputs differ with it
+        self.variant = 'float'
+
+    def optimize_for_inference(self, channels_last=True, quantize_fc=False):
+        """Fold the BatchNorm of each conv block into the 1x1 conv before it,
+        optionally run the convolutions in channels last memory format and
+        quantize the fully connected layers to dynamic int8. The model must be
+        in eval mode, BatchNorm then being a per channel affine map."""
+        assert not self.training, 'BatchNorm folding uses the running statistics: call eval() first'
+        blocks = [self.input_layer, self.conv_block1, self.conv_block2,
+                  self.conv_block3, self.conv_block4, self.conv_block5]
+        for block in blocks:
+            if isinstance(block[1], nn.BatchNorm2d):
+                block[0] = nn.utils.fusion.fuse_conv_bn_eval(block[0], block[1])
+                block[1] = nn.Identity()
+        if channels_last:
+            self.channels_last = True
+            for block in blocks:
+                block.to(memory_format=torch.channels_last)
+        if quantize_fc:
+            # the only Linear layers are the fully connected ones; they then run on CPU only
+            torch.quantization.quantize_dynamic(self, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        self.variant = 'folded' + ('-channels_last' if channels_last else '') + ('-int8_fc' if quantize_fc else '')
+        return self
 
     def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         x1 = self.pool(self.input_layer(x))
         x2 = self.pool(self.conv_block1(x1))
         x3 = self.pool(self.conv_block2(x2))
@@ -0,0 +1,204 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the Apache License, Version 2.0
+# found in the LICENSE file in the root directory of this source tree.
+
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from osgeo import gdal, gdal_array
+
+
+class WindowedReader:
+    """Read a raster (GeoTIFF, JP2, png...) through GDAL by strips of rows
+    aligned on its blocks, so that scenes larger than memory can be tiled
+    (see tiling.iter_tiles). Only the strips overlapping the last requested
+    rows and the next `read_ahead` strips, read in a background thread while
+    the caller works on the current ones, are held in memory.
+    Args:
+        path (str): raster file.
+        strip_rows (int): minimum rows per strip, rounded up to a multiple
+            of the block height. Default: 256.
+        read_ahead (int): strips read in advance. Default: 1.
+        bands (int, optional): number of bands kept, e.g. 3 for the RGB of
+            an RGBA image. As PIL convert('RGB'), palette rasters are expanded
+            to the colors of their table (3 bands by default), and the band of
+            gray rasters is repeated when more bands are requested. Default:
+            all.
+    """
+    def __init__(self, path, strip_rows=256, read_ahead=1, bands=None):
+        self.path = path
+        self.dataset = gdal.Open(str(path), gdal.GA_ReadOnly)
+        if self.dataset is None:
+            raise FileNotFoundError(f'GDAL cannot open {path}')
+        self.width = self.dataset.RasterXSize
+        self.height = self.dataset.RasterYSize
+        count = self.dataset.RasterCount
+        first = self.dataset.GetRasterBand(1)
+        color_table = first.GetColorTable() if first.GetRasterColorInterpretation() == gdal.GCI_PaletteIndex else None
+        # a gray band, possibly with an alpha band
+        gray = color_table is None and (count == 1 or (
+            count == 2 and self.dataset.GetRasterBand(2).GetRasterColorInterpretation() == gdal.GCI_AlphaBand))
+        self._palette = None
+        if color_table is not None:
+            self.bands = min(bands or 3, 4)
+            entries = [color_table.GetColorEntry(i) for i in range(color_table.GetCount())]
+            self._palette = np.array(entries, dtype=np.uint8).reshape(-1, 4)[:, :self.bands]
+        elif gray:
+            self.bands = bands or 1
+        else:
+            self.bands = bands or count
+            if self.bands > count:
+                raise ValueError(f'{path} has {count} bands, {self.bands} requested')
+        # bands read from the raster
+        self._band_list = [1] if color_table is not None or gray else list(range(1, self.bands + 1))
+        self.dtype = np.uint8 if color_table is not None else gdal_array.GDALTypeCodeToNumericTypeCode(first.DataType)
+        _, block_rows = first.GetBlockSize()
+        self.strip_rows = math.ceil(strip_rows / block_rows) * block_rows
+        self.read_ahead = read_ahead
+        # a single thread does all the reads: a GDAL dataset is not thread safe
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._strips = {}
+
+    @property
+    def shape(self):
+        return (self.height, self.width, self.bands)
+
+    @property
+    def geotransform(self):
+        return self.dataset.GetGeoTransform()
+
+    @property
+    def projection(self):
+        return self.dataset.GetProjection()
+
+    def read(self, xoff, yoff, xsize, ysize, buf_xsize=None, buf_ysize=None):
+        """(ysize, xsize, bands) array of a window, resampled to (buf_ysize,
+        buf_xsize) when given."""
+        return self._executor.submit(self._read, xoff, yoff, xsize, ysize, buf_xsize, buf_ysize).result()
+
+    def _read(self, xoff, yoff, xsize, ysize, buf_xsize=None, buf_ysize=None):
+        array = self.dataset.ReadAsArray(xoff, yoff, xsize, ysize, buf_xsize=buf_xsize, buf_ysize=buf_ysize,
+                                         band_list=self._band_list)
+        if array.ndim == 2:
+            array = array[None]
+        if self._palette is not None:
+            # indices beyond the table take its last color
+            return np.take(self._palette, array[0], axis=0, mode='clip')
+        if len(array) < self.bands:
+            # gray band repeated
+            array = np.repeat(array, self.bands, axis=0)
+        # (bands, rows, cols) to (rows, cols, bands)
+        return np.ascontiguousarray(np.moveaxis(array, 0, -1))
+
+    def _read_strip(self, index):
+        top = index * self.strip_rows
+        return self._read(0, top, self.width, min(self.strip_rows, self.height - top))
+
+    def _strip(self, index):
+        if index not in self._strips:
+            self._strips[index] = self._executor.submit(self._read_strip, index)
+        return self._strips[index]
+
+    def read_rows(self, row, n):
+        """(n, width, bands) array of the rows [row, row + n), clipped to the
+        scene. Rows must be requested in increasing order of row: strips
+        above row are released."""
+        n = min(n, self.height - row)
+        first, last = row // self.strip_rows, (row + n - 1) // self.strip_rows
+        for index in [i for i in self._strips if i < first]:
+            del self._strips[index]
+        n_strips = math.ceil(self.height / self.strip_rows)
+        for index in range(last + 1, min(last + 1 + self.read_ahead, n_strips)):
+            self._strip(index)
+        strips = [self._strip(index).result() for index in range(first, last + 1)]
+        top = first * self.strip_rows
+        rows = strips[0] if len(strips) == 1 else np.concatenate(strips)
+        return rows[row - top:row - top + n]
+
+    def iter_strips(self):
+        """Yield (row, strip) over the scene, strips being (rows, width,
+        bands) arrays aligned on the blocks of the raster."""
+        for row in range(0, self.height, self.strip_rows):
+            yield row, self.read_rows(row, self.strip_rows)
+
+    def read_decimated(self, max_size=2048):
+        """The whole scene decimated so that its largest side is at most
+        max_size pixels, read from the overviews when the raster has some."""
+        scale = max(max(self.width, self.height) / max_size, 1)
+        return self.read(0, 0, self.width, self.height,
+                         buf_xsize=max(round(self.width / scale), 1), buf_ysize=max(round(self.height / scale), 1))
+
+    def close(self):
+        self._executor.shutdown()
+        self._strips = {}
+        self.dataset = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GeoTiffWriter:
+    """Write a GeoTIFF window by window, e.g. the strips of rows
+    flushed by tiling.BlendMerger (it can be its sink), so that the output
+    never needs to be in memory. The file is internally tiled and compressed
+    (DEFLATE or ZSTD with a predictor), and a BigTIFF when it could exceed
+    4 GB. Windows aligned on the blocks (multiples of block_size rows) are
+    written straight to disk, others stay in the GDAL block cache until their
+    blocks are complete.
+    Args:
+        path (str): output file.
+        width, height (int): size of the raster.
+        geotransform (tuple, optional): GDAL geotransform.
+        projection (str, optional): WKT of the coordinate system.
+        dtype (int): GDAL data type. Default: gdal.GDT_Float32.
+        compress (str): 'DEFLATE' or 'ZSTD'. Default: 'DEFLATE'.
+        block_size (int): size of the internal tiles. Default: 256.
+        nodata (float, optional): no data value. Default: -9999.
+        bands (int): number of bands. Default: 1.
+    """
+    def __init__(self, path, width, height, geotransform=None, projection=None, dtype=gdal.GDT_Float32,
+                 compress='DEFLATE', block_size=256, nodata=-9999, bands=1):
+        floating = dtype in (gdal.GDT_Float32, gdal.GDT_Float64)
+        options = ['TILED=YES', f'BLOCKXSIZE={block_size}', f'BLOCKYSIZE={block_size}',
+                   f'COMPRESS={compress}',
+                   # floating point predictor for floats, horizontal differencing for integers
+                   f'PREDICTOR={3 if floating else 2}',
+                   'BIGTIFF=IF_SAFER']
+        driver = gdal.GetDriverByName('GTiff')
+        self.dataset = driver.Create(str(path), width, height, bands, dtype, options=options)
+        if self.dataset is None:
+            raise IOError(f'GDAL cannot create {path}')
+        if geotransform is not None:
+            self.dataset.SetGeoTransform(geotransform)
+        if projection:
+            self.dataset.SetProjection(projection)
+        self.bands = [self.dataset.GetRasterBand(i + 1) for i in range(bands)]
+        if nodata is not None:
+            for band in self.bands:
+                band.SetNoDataValue(nodata)
+
+    def write(self, array, row, col=0):
+        """Write the (rows, cols) array, or (bands, rows, cols) for several
+        bands, at offset (row, col)."""
+        for band, values in zip(self.bands, array.reshape(len(self.bands), *array.shape[-2:])):
+            band.WriteArray(values, col, row)
+
+    def __call__(self, row, block):
+        self.write(block, row)
+
+    def close(self):
+        if self.dataset is not None:
+            self.dataset.FlushCache()
+            self.bands = []
+            self.dataset = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
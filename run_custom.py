@@ -7,9 +7,11 @@ import matplotlib.pyplot as plt
 import torchmetrics
 from pathlib import Path
 import torch.nn as nn
+import torch.nn.functional as F
 from tqdm import tqdm
 from PIL import Image
 import math
+from functools import partial
 import torchvision.transforms.functional as TF
 import torchvision
 from torchvision.utils import save_image
@@ -19,6 +21,8 @@ from models.dpt_head import DPTHead
 import pytorch_lightning as pl
 from models.regressor import RNet
 import inference
+import tiling
+from raster_io import GeoTiffWriter, WindowedReader
 
 import seaborn as sns
 import seaborn_image as isns
@@ -28,33 +32,44 @@ torch.backends.quantized.engine = 'qnnpack'
 
 device = 'cpu'
 norm_path = 'saved_checkpoints/aerial_normalization_quantiles_predictor.ckpt'
-ckpt = torch.load(norm_path, map_location='cpu')
-state_dict = ckpt['state_dict']
 checkpoint = 'saved_checkpoints/compressed_SSLhuge.pth'
 PATH = 'highResMeta/crop'
+# predict a whole scene tiled in memory instead of the png crops of PATH
+SCENE = None # e.g. 'highResMeta/SiteC.png'
+TILE_SIZE = 256
+# tiles overlap by TILE_SIZE - STRIDE pixels, their predictions are blended with a Hann window
+STRIDE = 256
+# also write the SCENE prediction as a tiled, compressed GeoTIFF with the georeferencing of the scene
+# (with UNCERTAINTY, bands 2 to 4 hold the standard deviation, p10 and p90)
+OUTPUT_TIFF = None # e.g. OUTPUT_PATH + '/merged_CHM.tif'
 OUTPUT_PATH = 'highResMeta/output'
+BATCH_SIZE = 16
+# memory map the weights, so that processes of a host share them (torch >= 2.1)
+MMAP = False
+# fold the image normalization into the patch embedding of the model
+FOLD_NORM = False
+# also save the standard deviation, p10 and p90 of the predicted heights
+UNCERTAINTY = False
+# normalization of aerial images to the intensities of satellite images (see inference.evaluate):
+# 0 none (satellite images), 2 percentiles predicted by the normalization network.
+# 1 needs satellite reference images at the same coordinates.
+NORMTYPE = 0
 if not os.path.exists(OUTPUT_PATH):
     os.makedirs(OUTPUT_PATH)
 
 # 1- load normnet
-for k in list(state_dict.keys()):
-    if 'backbone.' in k:
-        new_k = k.replace('backbone.','')
-        state_dict[new_k] = state_dict.pop(k)
-        
-model_norm = inference.RNet(n_classes=6)
+model_norm = inference.load_normnet(norm_path, mmap=MMAP)
 model_norm = model_norm.to(device)
-model_norm = model_norm.eval()
-model_norm.load_state_dict(state_dict)
 
 
 # 2- load SSL model
-model = inference.SSLModule(ssl_path = checkpoint)
+model = inference.SSLModule(ssl_path = checkpoint, mmap=MMAP, fold_norm=FOLD_NORM, uncertainty=UNCERTAINTY)
 model.to(device)
 model = model.eval()
 
 # 3- image normalization for each image going through the encoder
-norm = T.Normalize((0.420, 0.411, 0.296), (0.213, 0.156, 0.143))
+# (folded into the model with FOLD_NORM)
+norm = nn.Identity() if FOLD_NORM else T.Normalize(inference.NORM_MEAN, inference.NORM_STD)
 norm = norm.to(device)
 class TreeDataset(torch.utils.data.Dataset):
     def __init__(self, dataset_path, transform):
@@ -77,18 +92,105 @@ class TreeDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.datapoints)
 
+    def sizes(self):
+        # (height, width) of each tile, read from the image headers only
+        return [Image.open(self.dataset_path + '/' + x).size[::-1] for x in self.datapoints]
 
 
-data = TreeDataset(dataset_path = PATH, transform = None)
-dataloader = torch.utils.data.DataLoader(data, batch_size=1, shuffle=False, num_workers=0)
-for batch, name in tqdm(dataloader):
-    batch.to(device)
-    pred = model(norm(batch))
-    pred = pred.detach().numpy().squeeze()
-    # save the prediction as numpy array
-    np.save(OUTPUT_PATH + '/' + name[0].replace('.png', '.npy'), pred)
-    fig, axs = plt.subplots(1, 2, figsize = (10, 5))
-    sns.heatmap(pred, ax = axs[0], cbar = True)
-    img = batch.detach().numpy().squeeze()
-    isns.imgplot(np.moveaxis(img, 0, -1), ax = axs[1])
-    plt.savefig(OUTPUT_PATH + '/' + name[0])
\ No newline at end of file
+
+def tile_affine(batch, sizes, levels=256):
+    """(scale, shift) of the aerial normalization of each tile of a padded
+    batch, computed on the tiles without their padding: percentiles of their
+    histograms of `levels` levels (None for other than 8 bit tiles, see
+    inference.percentiles), and quantiles predicted by the normalization network
+    on the tiles resized to its input size, in one batched call."""
+    crops = [img[:, :h, :w] for img, (h, w) in zip(batch, sizes)]
+    n_pix = model_norm.n_pix
+    resized = torch.cat([F.interpolate(crop[None], size=(n_pix, n_pix), mode='bilinear', align_corners=False)
+                         if crop.shape[-2:] != (n_pix, n_pix) else crop[None] for crop in crops])
+    with torch.no_grad():
+        quantiles = model_norm(resized)
+    p5In, p95In = torch.cat([inference.percentiles(crop[None], (5, 95), levels=levels) for crop in crops], dim=1)
+    return inference.percentile_affine(quantiles[:, :3], quantiles[:, 3:6], p5In, p95In)
+
+def predict(batch, sizes=None, levels=256):
+    """Predictions of a batch of tiles padded at the bottom right to the
+    (height, width) sizes of the tiles (default: no padding). levels: see
+    tile_affine."""
+    affine = None
+    if NORMTYPE == 2:
+        sizes = [tuple(batch.shape[-2:])] * len(batch) if sizes is None else sizes.tolist()
+        scale, shift = tile_affine(batch, sizes, levels)
+        fill = torch.tensor(inference.NORM_MEAN, dtype=batch.dtype, device=batch.device)
+        if FOLD_NORM:
+            affine = (scale, shift)
+        else:
+            batch = torch.addcmul(shift[:, :, None, None], batch, scale[:, :, None, None])
+        for img, (h, w), s, t in zip(batch, sizes, scale, shift):
+            # the padding is NORM_MEAN once rescaled, zero once normalized (see inference.pad_collate)
+            pad = ((fill - t) / s if FOLD_NORM else fill)[:, None, None]
+            img[:, h:] = pad
+            img[:, :h, w:] = pad
+    return model(norm(batch), affine)
+
+if SCENE is not None:
+    # tiles cut from the scene read by strips of rows, predictions blended into OUTPUT_PATH/merged_CHM.npy
+    # (and with UNCERTAINTY, their standard deviation, p10 and p90 into merged_CHM_uncertainty.npy)
+    scene = WindowedReader(SCENE, read_ahead=2, bands=3)
+    height, width = scene.shape[:2]
+    channels = 2 + len(model.chm_module_.decode_head.quantiles) if UNCERTAINTY else 1
+    sink = tiling.ArraySink(height, width, path=OUTPUT_PATH + '/merged_CHM.npy')
+    uncertainty_sink = None
+    if UNCERTAINTY:
+        uncertainty_sink = tiling.ArraySink(height, width, path=OUTPUT_PATH + '/merged_CHM_uncertainty.npy',
+                                            channels=channels - 1)
+    writer = None
+    if OUTPUT_TIFF is not None:
+        # one band per channel, the height first
+        writer = GeoTiffWriter(OUTPUT_TIFF, width, height, scene.geotransform, scene.projection, bands=channels)
+    def write_strip(row, block):
+        block = block.reshape(channels, *block.shape[-2:])
+        sink(row, block[0])
+        if uncertainty_sink is not None:
+            uncertainty_sink(row, block[1:])
+        if writer is not None:
+            writer(row, block)
+    merger = tiling.BlendMerger(height, width, TILE_SIZE, sink=write_strip, channels=channels)
+    tiles = tiling.iter_tiles(scene, TILE_SIZE, batch_size=BATCH_SIZE, stride=STRIDE)
+    # 8 bit scenes have 256 levels once in [0, 1], others (e.g. uint16) are sorted
+    levels = 256 if scene.dtype == np.uint8 else None
+    for preds, offsets in tqdm(tiling.predict_tiles(partial(predict, levels=levels), tiles, device)):
+        merger.add_batch(preds, offsets)
+    merger.close()
+    sink.array.flush()
+    if uncertainty_sink is not None:
+        uncertainty_sink.array.flush()
+    scene.close()
+    if writer is not None:
+        writer.close()
+else:
+    data = TreeDataset(dataset_path = PATH, transform = None)
+    # tiles of different sizes (e.g. scene edges) are batched per padded shape bucket
+    sampler = inference.BucketBatchSampler(data.sizes(), batch_size=BATCH_SIZE)
+    for shape, r in sampler.padding_report().items():
+        print(f"bucket {shape[0]}x{shape[1]}: {r['tiles']} tiles, {r['batches']} batches, {100 * r['padding']:.1f}% padding")
+    dataloader = torch.utils.data.DataLoader(data, batch_sampler=sampler, num_workers=0,
+                                             collate_fn=partial(inference.pad_collate, fill=inference.NORM_MEAN))
+    for batch, sizes, names in tqdm(dataloader):
+        batch = batch.to(device)
+        with torch.no_grad():
+            preds = predict(batch, sizes)
+        preds = preds.detach().cpu().numpy()
+        for pred, img, (h, w), name in zip(preds, batch.cpu().numpy(), sizes.tolist(), names):
+            pred, stats = pred[0, :h, :w], pred[1:, :h, :w]
+            # save the prediction as numpy array
+            np.save(OUTPUT_PATH + '/' + name.replace('.png', '.npy'), pred)
+            if UNCERTAINTY:
+                # (3, h, w): standard deviation, p10, p90
+                np.save(OUTPUT_PATH + '/' + name.replace('.png', '_uncertainty.npy'), stats)
+            fig, axs = plt.subplots(1, 2, figsize = (10, 5))
+            sns.heatmap(pred, ax = axs[0], cbar = True)
+            img = img[:, :h, :w]
+            isns.imgplot(np.moveaxis(img, 0, -1), ax = axs[1])
+            plt.savefig(OUTPUT_PATH + '/' + name)
+            plt.close(fig)
\ No newline at end of file
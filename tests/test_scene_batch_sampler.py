@@ -0,0 +1,47 @@
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+from inference import SceneBatchSampler
+
+
+class WorkerDataset(torch.utils.data.Dataset):
+    """Returns the index of each sample and the worker that loaded it."""
+    def __init__(self, n):
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return i, torch.utils.data.get_worker_info().id
+
+
+@pytest.mark.parametrize('n_scenes,crops,batch_size,num_workers', [(7, 36, 16, 3), (12, 36, 32, 10), (5, 20, 7, 2)])
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_each_scene_served_by_one_worker(n_scenes, crops, batch_size, num_workers, shuffle):
+    scenes = [i // crops for i in range(n_scenes * crops)]
+    sampler = SceneBatchSampler(scenes, batch_size, num_workers=num_workers, shuffle=shuffle)
+    loader = torch.utils.data.DataLoader(WorkerDataset(len(scenes)), batch_sampler=sampler, num_workers=num_workers)
+    workers = {}
+    n_batches = 0
+    for indices, worker_ids in loader:
+        n_batches += 1
+        batch_scenes = {scenes[i] for i in indices.tolist()}
+        assert len(batch_scenes) == 1, 'batches do not span scenes'
+        for i, w in zip(indices.tolist(), worker_ids.tolist()):
+            workers.setdefault(scenes[i], set()).add(w)
+    assert n_batches == len(sampler)
+    assert sorted(workers) == list(range(n_scenes)), 'every crop is served'
+    assert all(len(w) == 1 for w in workers.values()), workers
+
+
+def test_every_crop_once():
+    scenes = [i // 36 for i in range(7 * 36)]
+    sampler = SceneBatchSampler(scenes, 16, num_workers=3, shuffle=True)
+    indices = [i for batch in sampler for i in batch]
+    assert sorted(indices) == list(range(len(scenes)))
+    assert max(len(batch) for batch in sampler) <= 16
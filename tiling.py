@@ -0,0 +1,205 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the Apache License, Version 2.0
+# found in the LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+def load_scene(path):
+    """(H, W, 3) uint8 array of a scene, 1 byte per pixel and channel."""
+    return np.asarray(Image.open(path).convert('RGB'))
+
+
+def tile_offsets(height, width, tile_size=256, stride=None):
+    """Row and column offsets of the tiles of a (height, width) scene: the
+    tiles are all the (row, col) pairs, in row major order. Tiles overlap by
+    tile_size - stride pixels (stride defaults to tile_size, no overlap).
+    The whole scene is covered: when the size is not a multiple of the
+    stride, the last tile is shifted back to end at the scene border (so it
+    overlaps its neighbor), and scenes smaller than a tile get one tile at 0,
+    to be padded (see iter_tiles)."""
+    stride = stride or tile_size
+
+    def offsets(size):
+        last = max(size - tile_size, 0)
+        offsets = list(range(0, last + 1, stride))
+        if offsets[-1] != last:
+            offsets.append(last)
+        return offsets
+
+    return offsets(height), offsets(width)
+
+
+def to_tensor(tiles):
+    """(B, C, H, W) float tensor in [0, 1] of (B, H, W, C) tiles of unsigned
+    integers, divided by the largest value of their dtype: 255 for uint8 as
+    TF.to_tensor, 65535 for uint16... Other dtypes have no known range and
+    raise a ValueError."""
+    tiles = np.ascontiguousarray(tiles)
+    if not np.issubdtype(tiles.dtype, np.unsignedinteger):
+        raise ValueError(f'tiles of dtype {tiles.dtype} have no known range, expected unsigned integers '
+                         '(e.g. uint8 or uint16 rasters)')
+    if tiles.dtype == np.uint8:
+        return torch.from_numpy(tiles).permute(0, 3, 1, 2).float().div_(255)
+    # torch has no uint16 or uint32 tensors
+    tiles = tiles.astype(np.float32) / np.iinfo(tiles.dtype).max
+    return torch.from_numpy(tiles).permute(0, 3, 1, 2)
+
+
+def iter_tiles(scene, tile_size=256, batch_size=16, stride=None):
+    """Cut a (H, W, C) scene into tiles, without intermediate files. The
+    scene is either a decoded array or a reader of rows such as
+    raster_io.WindowedReader (with `shape` and `read_rows(row, n)`), which
+    bounds the memory to a few strips of rows whatever the scene size.
+    See tile_offsets for stride. Tiles of scenes smaller than tile_size are
+    padded by repeating their edges, BlendMerger crops their predictions.
+    Yields:
+        (batch, offsets): (B, C, tile_size, tile_size) float tensor of the
+            tiles (see to_tensor) and (B, 2) long tensor of their (row, col)
+            offsets in the scene.
+    """
+    rows, cols = tile_offsets(scene.shape[0], scene.shape[1], tile_size, stride)
+    tiles, offsets = [], []
+    for row in rows:
+        if isinstance(scene, np.ndarray):
+            band = scene[row:row + tile_size]
+        else:
+            band = scene.read_rows(row, tile_size)
+        for col in cols:
+            tiles.append(pad_tile(band[:, col:col + tile_size], tile_size))
+            offsets.append((row, col))
+            if len(tiles) == batch_size:
+                yield to_tensor(np.stack(tiles)), torch.tensor(offsets)
+                tiles, offsets = [], []
+    if tiles:
+        yield to_tensor(np.stack(tiles)), torch.tensor(offsets)
+
+
+def pad_tile(tile, tile_size):
+    """(tile_size, tile_size, C) tile, padded at the bottom right by
+    repeating its edges."""
+    h, w = tile.shape[:2]
+    if (h, w) == (tile_size, tile_size):
+        return tile
+    return np.pad(tile, ((0, tile_size - h), (0, tile_size - w), (0, 0)), mode='edge')
+
+
+def predict_tiles(model, tiles, device='cpu'):
+    """Run model, e.g. a normalization followed by SSLModule, on batches of
+    tiles as yielded by iter_tiles.
+    Yields:
+        (preds, offsets): (B, C, H, W) numpy predictions, with all the output
+            channels of the model (e.g. the uncertainty of SSLModule), and
+            (B, 2) offsets.
+    """
+    with torch.no_grad():
+        for batch, offsets in tiles:
+            preds = model(batch.to(device))
+            yield preds.cpu().numpy(), offsets
+
+
+def blend_window(height, width, window='hann'):
+    """(height, width) weights of a tile prediction in the mosaic: 'hann'
+    (raised cosine, decreasing towards the tile borders, where the model
+    lacks context) or 'uniform'. Hann weights do not reach zero, so that
+    scene borders covered by a single tile keep their prediction."""
+    if window == 'uniform':
+        return np.ones((height, width), dtype=np.float32)
+    assert window == 'hann', f'unknown window {window}'
+    return np.outer(np.hanning(height + 2)[1:-1], np.hanning(width + 2)[1:-1]).astype(np.float32)
+
+
+class ArraySink:
+    """Sink of BlendMerger writing the rows of the mosaic into a (height,
+    width) float32 array, or (channels, height, width) for several channels,
+    in memory or, with path, in a memory mapped .npy file that never needs to
+    fit in memory."""
+    def __init__(self, height, width, path=None, channels=1):
+        shape = (height, width) if channels == 1 else (channels, height, width)
+        if path is None:
+            self.array = np.zeros(shape, dtype=np.float32)
+        else:
+            self.array = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+
+    def __call__(self, row, block):
+        self.array[..., row:row + block.shape[-2], :] = block
+
+
+class BlendMerger:
+    """Mosaic of overlapping tile predictions, weighted by a smooth window
+    (see blend_window) and normalized by the sum of the weights. Tiles must be
+    added in row major order of their offsets (as yielded by iter_tiles): the
+    accumulators only hold tile_size + strip_rows rows of the scene, and rows
+    that no later tile can cover are normalized and flushed by strips of
+    strip_rows rows to sink(row, block), with block a (n, width) float32 array,
+    or (channels, n, width) for several channels. Pixels covered by no tile
+    are set to fill.
+    Args:
+        height, width (int): size of the scene.
+        tile_size (int): size of the tiles. Default: 256.
+        sink (callable): receives the rows of the mosaic, see ArraySink.
+        window (str): 'hann' or 'uniform'. Default: 'hann'.
+        strip_rows (int): rows flushed at a time. Default: tile_size.
+        fill (float): value of uncovered pixels. Default: 0.
+        channels (int): channels of the predictions, each blended with the
+            same weights. Default: 1.
+    """
+    def __init__(self, height, width, tile_size=256, sink=None, window='hann', strip_rows=None, fill=0.0,
+                 channels=1):
+        self.height, self.width = height, width
+        self.tile_size = tile_size
+        self.sink = sink
+        self.window = window
+        self.strip_rows = strip_rows or tile_size
+        self.fill = fill
+        self.channels = channels
+        rows = tile_size + self.strip_rows
+        self.acc = np.zeros((channels, rows, width), dtype=np.float32)
+        self.weights = np.zeros((rows, width), dtype=np.float32)
+        # scene row of the first accumulator row
+        self.top = 0
+        self._windows = {}
+
+    def _window(self, height, width):
+        if (height, width) not in self._windows:
+            self._windows[(height, width)] = blend_window(height, width, self.window)
+        return self._windows[(height, width)]
+
+    def _flush(self, rows):
+        rows = min(rows, self.height - self.top)
+        weights = self.weights[:rows]
+        block = np.full((self.channels, rows, self.width), self.fill, dtype=np.float32)
+        np.divide(self.acc[:, :rows], weights, out=block, where=weights > 0)
+        self.sink(self.top, block[0] if self.channels == 1 else block)
+        # shift the accumulators up
+        self.acc[:, :-rows] = self.acc[:, rows:]
+        self.acc[:, -rows:] = 0
+        self.weights[:-rows] = self.weights[rows:]
+        self.weights[-rows:] = 0
+        self.top += rows
+
+    def add(self, pred, row, col):
+        """Add the (h, w) or (channels, h, w) prediction of the tile at offset
+        (row, col)."""
+        assert row >= self.top, 'tiles must be added in row major order'
+        pred = pred.reshape(self.channels, *pred.shape[-2:])[:, :self.height - row, :self.width - col]
+        h, w = pred.shape[-2:]
+        while row + h > self.top + len(self.weights):
+            # rows above the tile are final
+            self._flush(self.strip_rows)
+        window = self._window(h, w)
+        r = row - self.top
+        self.acc[:, r:r + h, col:col + w] += pred * window
+        self.weights[r:r + h, col:col + w] += window
+
+    def add_batch(self, preds, offsets):
+        for pred, (row, col) in zip(preds, offsets.tolist()):
+            self.add(pred, row, col)
+
+    def close(self):
+        """Flush the remaining rows."""
+        while self.top < self.height:
+            self._flush(self.strip_rows)